@@ -0,0 +1,450 @@
+"""Benchmark stages of the build, and the app under load.
+
+Each benchmark prints its timings as JSON, and optionally saves them to a file along
+with the commit they were run on, so regressions can be compared across commits.
+
+Use like:
+
+$ python -m build.benchmark make_sqlite data.json --workers 4 --batch 1000
+$ python -m build.benchmark make_recommendations data.db --batches 100 1000
+$ python -m build.benchmark make_search_index data.db --procs 1 4
+$ python -m build.benchmark app .whoosh_index --concurrency 16 --requests 1000
+
+The make_sqlite benchmark loads the file with the line by line path and with the bulk
+path, and checks that both produce the same database. The make_recommendations and
+make_search_index benchmarks run each configuration on a copy of the database. The
+app benchmark serves the index with the gevent server in a subprocess, requests /,
+/recs/<id> and /api/recs from concurrent clients, then collects the server side
+breakdown from /metrics. Its search cache is off, so / times searches, not hits.
+
+The suite runs everything on synthetic data (see synthetic_snatches):
+
+$ python -m build.benchmark --output bench.json suite --users 20000 --groups 10000
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import contextlib
+import json
+import os
+import platform
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+import requests
+
+from app.search import STORE_FILENAME, SUGGEST_FILENAME, SearchIndex
+
+from . import (
+    make_rec_store,
+    make_recommendations,
+    make_search_index,
+    make_sqlite,
+    make_suggest_index,
+    synthetic_snatches,
+)
+
+APP_ROUTES = ("/", "/recs/<id>", "/api/recs")
+SERVER_START_SECONDS = 60
+
+
+def parse_args():
+    """Parse CLI args."""
+    p = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    p.add_argument("--output", type=Path, help="Save the results to this JSON file.")
+    sub = p.add_subparsers(dest="benchmark", required=True)
+
+    s = sub.add_parser("make_sqlite", help="Line by line vs bulk load.")
+    s.add_argument("json_path", type=Path, help="Path to the raw JSON data.")
+    s.add_argument("--workers", type=int, default=4, help="Bulk load parser processes.")
+    s.add_argument("--batch", type=int, default=1000, help="Bulk load lines per txn.")
+
+    s = sub.add_parser("make_recommendations", help="Engines and batch sizes.")
+    s.add_argument("db_path", type=Path, help="Path to the sqlite data.")
+    add_recommendations_args(s)
+
+    s = sub.add_parser("make_search_index", help="Indexing processes and schemas.")
+    s.add_argument("db_path", type=Path, help="Path to the sqlite data.")
+    add_search_index_args(s)
+
+    s = sub.add_parser("app", help="Routes under concurrent load.")
+    s.add_argument("index_path", type=Path, help="Path to the index to serve.")
+    add_app_args(s)
+
+    s = sub.add_parser("suite", help="Everything, on synthetic data.")
+    s.add_argument("--users", type=int, default=10000, help="Synthetic users.")
+    s.add_argument("--groups", type=int, default=5000, help="Synthetic groups.")
+    s.add_argument("--artists", type=int, default=1000, help="Synthetic artists.")
+    s.add_argument("--skew", type=float, default=1.0, help="Popularity power law.")
+    s.add_argument("--workers", type=int, default=4, help="Bulk load parser processes.")
+    add_recommendations_args(s)
+    add_search_index_args(s)
+    add_app_args(s)
+    return p.parse_args()
+
+
+def add_recommendations_args(p: argparse.ArgumentParser) -> None:
+    """Add the args of the make_recommendations benchmark."""
+    p.add_argument(
+        "--engines",
+        nargs="+",
+        default=["sql", "sparse"],
+        choices=["sql", "sparse"],
+        help="Engines to time.",
+    )
+    p.add_argument(
+        "--batches", nargs="+", type=int, default=[100, 1000], help="Batch sizes."
+    )
+
+
+def add_search_index_args(p: argparse.ArgumentParser) -> None:
+    """Add the args of the make_search_index benchmark."""
+    p.add_argument(
+        "--procs", nargs="+", type=int, default=[1], help="Indexing processes."
+    )
+    p.add_argument(
+        "--lean", action="store_true", default=False, help="Time the lean schema too."
+    )
+
+
+def add_app_args(p: argparse.ArgumentParser) -> None:
+    """Add the args of the app benchmark."""
+    p.add_argument("--concurrency", type=int, default=8, help="Concurrent clients.")
+    p.add_argument("--requests", type=int, default=500, help="Requests per route.")
+
+
+def git_commit() -> str:
+    """Get the commit being benchmarked, None if it is unknown."""
+    try:
+        result = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=Path(__file__).parent,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return result.stdout.strip()
+
+
+def dump_db(db_path: Path) -> list:
+    """Get the full contents of a database as SQL statements."""
+    with contextlib.closing(sqlite3.connect(db_path)) as conn:
+        return list(conn.iterdump())
+
+
+def bench_make_sqlite(json_path: Path, workers: int = 4, batch: int = 1000) -> dict:
+    """Time the line by line and bulk load paths of make_sqlite."""
+    mb = json_path.stat().st_size / 2**20
+    with json_path.open("rb") as f:
+        n_lines = sum(1 for _ in f)
+
+    results = dict(mb=mb, lines=n_lines)
+    with tempfile.TemporaryDirectory() as tmp:
+        per_line_db = Path(tmp) / "per_line.db"
+        make_sqlite.make_fresh_db(per_line_db)
+        start = time.perf_counter()
+        with json_path.open("rb") as f:
+            for line in f:
+                make_sqlite.process_line(per_line_db, line)
+        results["per_line_seconds"] = time.perf_counter() - start
+
+        bulk_db = Path(tmp) / "bulk.db"
+        make_sqlite.make_fresh_db(bulk_db)
+        start = time.perf_counter()
+        make_sqlite.bulk_load(bulk_db, json_path, workers=workers, batch=batch)
+        results["bulk_seconds"] = time.perf_counter() - start
+
+        results["identical"] = dump_db(per_line_db) == dump_db(bulk_db)
+
+    for path in ("per_line", "bulk"):
+        seconds = results[f"{path}_seconds"]
+        results[f"{path}_lines_per_second"] = n_lines / seconds
+        results[f"{path}_mb_per_second"] = mb / seconds
+    results["speedup"] = results["per_line_seconds"] / results["bulk_seconds"]
+    return results
+
+
+def count_groups(db_path: Path) -> int:
+    """Count the groups in a database."""
+    with contextlib.closing(sqlite3.connect(db_path)) as conn:
+        return conn.execute("select count(*) from groups").fetchone()[0]
+
+
+def bench_make_recommendations(
+    db_path: Path, engines=("sql", "sparse"), batches=(100, 1000)
+) -> dict:
+    """Time make_recommendations with each engine and batch size."""
+    n_groups = count_groups(db_path)
+    runs = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for engine in engines:
+            for batch in batches:
+                copy = Path(tmp) / "data.db"
+                shutil.copy(db_path, copy)
+                start = time.perf_counter()
+                make_recommendations.run(copy, engine=engine, batch=batch)
+                seconds = time.perf_counter() - start
+                with contextlib.closing(sqlite3.connect(copy)) as conn:
+                    sql = "select count(*) from recommendations"
+                    rows = conn.execute(sql).fetchone()[0]
+                runs.append(
+                    dict(
+                        engine=engine,
+                        batch=batch,
+                        seconds=seconds,
+                        groups_per_second=n_groups / seconds,
+                        rows=rows,
+                    )
+                )
+                copy.unlink()
+    return dict(groups=n_groups, runs=runs)
+
+
+def bench_make_search_index(db_path: Path, procs=(1,), lean: bool = False) -> dict:
+    """Time make_search_index with each number of processes and schema."""
+    runs = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for schema_lean in (False, True) if lean else (False,):
+            for n_procs in procs:
+                index_path = Path(tmp) / "index"
+                start = time.perf_counter()
+                docs = make_search_index.make_index(
+                    db_path, index_path, procs=n_procs, lean=schema_lean
+                )
+                seconds = time.perf_counter() - start
+                runs.append(
+                    dict(
+                        procs=n_procs,
+                        lean=schema_lean,
+                        docs=docs,
+                        seconds=seconds,
+                        docs_per_second=docs / seconds,
+                        index_mb=make_search_index.index_size(index_path) / 2**20,
+                    )
+                )
+                shutil.rmtree(index_path)
+    return dict(runs=runs)
+
+
+def free_port() -> int:
+    """Find a free port to serve on."""
+    with contextlib.closing(socket.socket()) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@contextlib.contextmanager
+def serve(index_path: Path, cache_size: int = None):
+    """Serve an index with the gevent server in a subprocess, yielding its url.
+
+    If given, cache_size sets the size of its search cache, 0 to disable it.
+    """
+    port = free_port()
+    env = dict(os.environ, WHOOSH_INDEX_DIR=str(index_path), PORT=str(port))
+    if cache_size is not None:
+        env["SEARCH_CACHE_SIZE"] = str(cache_size)
+    env.pop("REC_STORE_PATH", None)
+    url = f"http://127.0.0.1:{port}"
+    # the server logs every request to stderr, so that is only read on failure
+    log = tempfile.TemporaryFile()
+    server = subprocess.Popen([sys.executable, "-m", "app.wsgi"], env=env, stderr=log)
+    try:
+        deadline = time.monotonic() + SERVER_START_SECONDS
+        while True:
+            if server.poll() is not None:
+                log.seek(0)
+                message = log.read().decode(errors="replace")[-2000:]
+                raise RuntimeError(f"The server exited on startup:\n{message}")
+            try:
+                requests.get(f"{url}/metrics", timeout=1).raise_for_status()
+                break
+            except requests.RequestException:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.1)
+        yield url
+    finally:
+        server.terminate()
+        server.wait()
+        log.close()
+
+
+def app_paths(index_path: Path, n: int, seed: int = 0) -> dict:
+    """Sample request paths of each benchmarked route."""
+    with contextlib.closing(SearchIndex(index_path)) as index:
+        store = index.store
+        if store is not None:
+            group_ids = [
+                g for g in store.group_ids.tolist() if store.recommendations(g)
+            ]
+            names = {g: store.group(g)["name"] for g in group_ids}
+        else:
+            docs = index.current().searcher.all_stored_fields()
+            names = {
+                i["group_id"]: i["name"] for i in docs if i.get("recommendations_str")
+            }
+            group_ids = sorted(names)
+
+    rng = np.random.default_rng(seed)
+    sample = rng.choice(group_ids, size=n).tolist()
+    return {
+        "/": [("/", dict(q=names[g])) for g in sample],
+        "/recs/<id>": [(f"/recs/{g}", None) for g in sample],
+        "/api/recs": [("/api/recs", dict(group_id=g)) for g in sample],
+    }
+
+
+def latency_stats(latencies: list, seconds: float, errors: int) -> dict:
+    """Summarize the latencies of a load test."""
+    ms = np.array(latencies) * 1000
+    return dict(
+        requests=len(latencies),
+        errors=errors,
+        seconds=seconds,
+        requests_per_second=len(latencies) / seconds,
+        mean_ms=float(ms.mean()),
+        p50_ms=float(np.percentile(ms, 50)),
+        p90_ms=float(np.percentile(ms, 90)),
+        p99_ms=float(np.percentile(ms, 99)),
+        max_ms=float(ms.max()),
+    )
+
+
+def load(url: str, paths: list, concurrency: int) -> dict:
+    """Request paths from concurrent clients, timing each request."""
+    local = threading.local()
+
+    def get(path_params):
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        path, params = path_params
+        start = time.perf_counter()
+        response = local.session.get(f"{url}{path}", params=params)
+        return time.perf_counter() - start, response.status_code
+
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as pool:
+        results = list(pool.map(get, paths))
+    seconds = time.perf_counter() - start
+
+    errors = sum(status != 200 for _, status in results)
+    return latency_stats([i for i, _ in results], seconds, errors)
+
+
+def bench_app(index_path: Path, concurrency: int = 8, n_requests: int = 500) -> dict:
+    """Time the routes of the app under concurrent load."""
+    paths = app_paths(index_path, n_requests)
+    results = dict(concurrency=concurrency, routes=collections.OrderedDict())
+    # names repeat across the sample, so without a cache it times search, not hits
+    with serve(index_path, cache_size=0) as url:
+        # open the index before timing. These requests are in the server metrics.
+        load(url, [i for route in APP_ROUTES for i in paths[route][:10]], 1)
+
+        for route in APP_ROUTES:
+            results["routes"][route] = load(url, paths[route], concurrency)
+        results["server_metrics"] = requests.get(f"{url}/metrics").json()
+    return results
+
+
+def bench_suite(
+    users: int = 10000,
+    groups: int = 5000,
+    artists: int = 1000,
+    skew: float = 1.0,
+    workers: int = 4,
+    engines=("sql", "sparse"),
+    batches=(100, 1000),
+    procs=(1,),
+    lean: bool = False,
+    concurrency: int = 8,
+    n_requests: int = 500,
+) -> dict:
+    """Run every benchmark on synthetic data."""
+    results = dict(
+        synthetic=dict(users=users, groups=groups, artists=artists, skew=skew)
+    )
+    with tempfile.TemporaryDirectory() as tmp:
+        json_path, db_path = Path(tmp) / "users.json", Path(tmp) / "data.db"
+        index_path = Path(tmp) / "index"
+
+        start = time.perf_counter()
+        synthetic_snatches.write_lines(
+            json_path, n_users=users, n_groups=groups, n_artists=artists, skew=skew
+        )
+        results["synthetic"]["seconds"] = time.perf_counter() - start
+
+        results["make_sqlite"] = bench_make_sqlite(json_path, workers=workers)
+        make_sqlite.make_fresh_db(db_path)
+        make_sqlite.bulk_load(db_path, json_path, workers=workers)
+        make_sqlite.make_indexes(db_path)
+
+        results["make_recommendations"] = bench_make_recommendations(
+            db_path, engines=engines, batches=batches
+        )
+        make_recommendations.run(db_path, engine="sparse", batch=max(batches))
+
+        results["make_search_index"] = bench_make_search_index(
+            db_path, procs=procs, lean=lean
+        )
+        make_search_index.make_index(db_path, index_path)
+        make_rec_store.make_store(db_path, index_path / STORE_FILENAME)
+        make_suggest_index.make_suggest_index(db_path, index_path / SUGGEST_FILENAME)
+
+        results["app"] = bench_app(index_path, concurrency, n_requests)
+    return results
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    if args.benchmark == "make_sqlite":
+        results = bench_make_sqlite(args.json_path, args.workers, args.batch)
+    elif args.benchmark == "make_recommendations":
+        results = bench_make_recommendations(
+            args.db_path, engines=args.engines, batches=args.batches
+        )
+    elif args.benchmark == "make_search_index":
+        results = bench_make_search_index(
+            args.db_path, procs=args.procs, lean=args.lean
+        )
+    elif args.benchmark == "app":
+        results = bench_app(args.index_path, args.concurrency, args.requests)
+    elif args.benchmark == "suite":
+        results = bench_suite(
+            users=args.users,
+            groups=args.groups,
+            artists=args.artists,
+            skew=args.skew,
+            workers=args.workers,
+            engines=args.engines,
+            batches=args.batches,
+            procs=args.procs,
+            lean=args.lean,
+            concurrency=args.concurrency,
+            n_requests=args.requests,
+        )
+
+    results = dict(
+        benchmark=args.benchmark,
+        commit=git_commit(),
+        created_at=time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        python=platform.python_version(),
+        cpus=os.cpu_count(),
+        **results,
+    )
+    print(json.dumps(results, indent=2))
+    if args.output:
+        args.output.write_text(json.dumps(results, indent=2))
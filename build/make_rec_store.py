@@ -0,0 +1,134 @@
+"""Export recommendations and group metadata into a memory mapped store.
+
+The app maps the store at startup and uses it to answer recommendation and group
+lookups without touching the search index. See app.store for the file layout.
+
+Use like:
+
+$ python -m build.make_rec_store data.db .whoosh_index/recommendations.bin
+
+The app looks for the store in the whoosh index directory by default, so it ships
+along with the index.
+"""
+
+import argparse
+import contextlib
+import sqlite3
+import typing
+from pathlib import Path
+
+import numpy as np
+
+from app.store import write_arrays
+
+from .make_recommendations import N_RECOMMENDATIONS
+
+GROUPS_SQL = """
+select
+    group_id,
+    groups.name,
+    artists.name as artist_name
+from groups
+inner join artists on groups.artist_id = artists.artist_id
+order by group_id
+"""
+
+RECS_SQL = """
+select group_id, recommendation_group_id, recommendation_number, lift
+from recommendations
+order by group_id, recommendation_number
+"""
+
+
+def parse_args():
+    """Parse CLI args."""
+    p = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    p.add_argument(
+        "db_path", type=Path, help="Path to the sqlite data.",
+    )
+    p.add_argument(
+        "store_path", type=Path, help="Path to save the store.",
+    )
+    return p.parse_args()
+
+
+def encode_strings(
+    encoded: typing.Sequence[bytes],
+) -> typing.Tuple[np.ndarray, np.ndarray]:
+    """Get the offsets and the blob of a list of encoded strings."""
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(i) for i in encoded], out=offsets[1:])
+    return offsets, np.frombuffer(b"".join(encoded), dtype=np.uint8)
+
+
+class StringTable:
+    """Collect strings into a utf-8 blob, storing each distinct string once."""
+
+    def __init__(self):
+        self.numbers = {}
+        self.encoded = []
+
+    def add(self, s: str) -> int:
+        """Add a string, returning its number."""
+        if s not in self.numbers:
+            self.numbers[s] = len(self.encoded)
+            self.encoded.append(s.encode())
+        return self.numbers[s]
+
+    def arrays(self) -> typing.Tuple[np.ndarray, np.ndarray]:
+        """Get the offsets and the blob."""
+        return encode_strings(self.encoded)
+
+
+def make_offsets(rows: np.ndarray, n: int) -> np.ndarray:
+    """Offsets into a list sorted by row, where rows[i] is the row of element i."""
+    offsets = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=n), out=offsets[1:])
+    return offsets
+
+
+def make_store_arrays(conn: sqlite3.Connection) -> typing.Dict[str, np.ndarray]:
+    """Read the groups and recommendations into the store arrays."""
+    strings = StringTable()
+    group_ids, names, artist_names = [], [], []
+    for group_id, name, artist_name in conn.execute(GROUPS_SQL):
+        group_ids.append(group_id)
+        names.append(strings.add(name))
+        artist_names.append(strings.add(artist_name))
+    group_ids = np.array(group_ids, dtype=np.int32)
+
+    row_of = np.full(group_ids.max() + 1 if len(group_ids) else 0, -1, np.int32)
+    row_of[group_ids] = np.arange(len(group_ids))
+
+    candidates = np.array(conn.execute(RECS_SQL).fetchall()).reshape(-1, 4)
+    candidate_rows = row_of[candidates[:, 0].astype(np.int64)]
+    is_rec = candidates[:, 2] <= N_RECOMMENDATIONS
+
+    string_offsets, string_data = strings.arrays()
+    return dict(
+        row_of=row_of,
+        group_id=group_ids,
+        name=np.array(names, dtype=np.int32),
+        artist_name=np.array(artist_names, dtype=np.int32),
+        rec_offsets=make_offsets(candidate_rows[is_rec], len(group_ids)),
+        recs=candidates[is_rec, 1].astype(np.int32),
+        candidate_offsets=make_offsets(candidate_rows, len(group_ids)),
+        candidates=candidates[:, 1].astype(np.int32),
+        candidate_lift=candidates[:, 3].astype(np.float32),
+        string_offsets=string_offsets,
+        strings=string_data,
+    )
+
+
+def make_store(db_path: Path, store_path: Path) -> None:
+    """Export the database into a store file."""
+    with contextlib.closing(sqlite3.connect(db_path)) as conn:
+        arrays = make_store_arrays(conn)
+    write_arrays(store_path, arrays)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    make_store(args.db_path, args.store_path)
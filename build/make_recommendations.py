@@ -3,36 +3,59 @@
 This can take awhile so it is done as an extra step and stored within the sqlite
 database. It assumes make_sqlite has already been run. 
 
-Larger batch sizes take exponentially longer to run due to the resource intensive algo.
+There are two engines. The sql engine runs APRIORI_SQL in batches of referent groups;
+larger batch sizes take exponentially longer to run due to the resource intensive algo.
+The sparse engine loads the snatches into memory once as a user x group sparse matrix
+and computes the same lift scores with sparse matrix products. It needs more memory
+but takes minutes rather than hours.
 
 Use like:
 
 $ python -m build.make_recommendations data.db --batch 100
+$ python -m build.make_recommendations data.db --batch 100 --workers 8 --resume
+$ python -m build.make_recommendations data.db --engine sparse --batch 1000
 
-Later, find the recommendations table in the sqlite database.
+Batches of the sql engine can be computed by a pool of worker processes reading from
+the database in WAL mode while this process writes the results. Each finished batch
+is recorded in recommendations_progress in the same transaction as its rows, so a run
+that dies partway through can be picked up again with --resume.
+
+Later, find the recommendations table in the sqlite database. It keeps the best
+N_CANDIDATES consequents of each group with their support, consequent support and lift,
+of which the first N_RECOMMENDATIONS are shown as the group's recommendations.
 """
 
 import argparse
-import os
+import contextlib
+import functools
+import multiprocessing
 import sqlite3
 import typing
 from pathlib import Path
 
+import numpy as np
 import tqdm
+from scipy import sparse
 
-# see those ?s that need to be filled ?
-APRIORI_SQL = """
-insert into recommendations (
-    group_id, recommendation_group_id, recommendation_number
-) 
+# tuning parameters for the apriori algorithm, shared by both engines.
+MIN_SUPPORT = 15
+ALPHA = 0.0
+BETA = 100.0
 
+# recommendations shown for a group, and the deeper list of scored candidates kept for
+# re-ranking (e.g. for a basket of groups).
+N_RECOMMENDATIONS = 10
+N_CANDIDATES = 50
+
+# see those :params that need to be filled :
+APRIORI_SQL = """
 with config as (
 	select
-		15 as min_support,
-        0.0 as alpha,
-	    100.0 as beta,
-	    ? as lower, --inclusive
-	    ? as upper, --exclusive
+		:min_support as min_support,
+        :alpha as alpha,
+	    :beta as beta,
+	    :lower as lower, --inclusive
+	    :upper as upper, --exclusive
 		count(*) as total_snatches
 
 	from snatches
@@ -43,6 +66,7 @@ apriori as (
     select
         referent.group_id as referent_id,
         consequent.group_id as consequent_id,
+        count(*) as support,
         max(consequent_group.snatch_count + alpha) / max(config.total_snatches + alpha + beta) as consequent_support,
         (
             -- lift = confidence  / consequent support
@@ -51,7 +75,10 @@ apriori as (
             -- therefore lift = (p(b | a) / p(a)) / p(b)
             ((count(*) + max(alpha)) / max(referent_group.snatch_count + alpha + beta))
             / (max(consequent_group.snatch_count + alpha) / max(config.total_snatches + alpha + beta))
-        ) as lift
+        ) as lift,
+        -- lift without the factors shared by all consequents of a referent. Ranks
+        -- the same as lift, but the rounding of ties does not depend on the total.
+        (count(*) + max(alpha)) / max(consequent_group.snatch_count + alpha) as relative_lift
 
     from config
 
@@ -78,7 +105,10 @@ apriori as (
 
 ranked as (
     select
-        row_number() over (partition by referent_id order by lift desc, consequent_support desc) as rn
+        row_number() over (
+            partition by referent_id
+            order by relative_lift desc, consequent_support desc, consequent_id
+        ) as rn
         , *
     from apriori
     where lift > 1
@@ -87,9 +117,23 @@ ranked as (
 select
     referent_id as group_id,
     consequent_id as recommendation_id,
-    rn as recommendation_number
+    rn as recommendation_number,
+    support,
+    consequent_support,
+    lift
 from ranked
-where rn <= 10
+where rn <= :n_candidates
+"""
+
+INSERT_SQL = """
+insert into recommendations (
+    group_id,
+    recommendation_group_id,
+    recommendation_number,
+    support,
+    consequent_support,
+    lift
+) values (?, ?, ?, ?, ?, ?)
 """
 
 
@@ -104,24 +148,65 @@ def parse_args():
     p.add_argument(
         "--batch", type=int, default=100, help="Set the batch size.",
     )
-    return p.parse_args()
+    p.add_argument(
+        "--engine",
+        choices=("sql", "sparse"),
+        default="sql",
+        help="Compute recommendations in SQLite or with in-memory sparse matrices.",
+    )
+    p.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes computing sql engine batches. default 1.",
+    )
+    p.add_argument(
+        "--resume",
+        action="store_true",
+        default=False,
+        help="Keep finished batches from a previous run rather than starting over.",
+    )
+    args = p.parse_args()
+    if args.workers < 1:
+        p.error("--workers must be at least 1.")
+    if args.workers > 1 and args.engine != "sql":
+        p.error("--workers is only supported by the sql engine.")
+    return args
 
 
-def rebuild_table(db_path):
-    """Rebuild the recommendations table."""
-    with sqlite3.connect(db_path) as conn:
-        conn.execute("drop table if exists recommendations")
+def rebuild_table(db_path, resume: bool = False):
+    """Rebuild the recommendations and progress tables.
+
+    If resuming, existing tables are kept as they are.
+    """
+    with contextlib.closing(sqlite3.connect(db_path)) as conn, conn:
+        if not resume:
+            conn.execute("drop table if exists recommendations")
+            conn.execute("drop table if exists recommendations_progress")
         sql = """
-        create table recommendations (
+        create table if not exists recommendations (
             group_id integer not null,
             recommendation_group_id integer not null,
             recommendation_number integer not null,
+            support integer not null, -- users with both groups
+            consequent_support real not null,
+            lift real not null,
             foreign key (group_id) references groups(group_id),
             foreign key (recommendation_group_id) references groups(group_id)
         )
         """
         conn.execute(sql)
 
+        # lower/upper limits of batches which are done.
+        sql = """
+        create table if not exists recommendations_progress (
+            lower integer not null, --inclusive
+            upper integer not null, --exclusive
+            primary key (lower, upper)
+        )
+        """
+        conn.execute(sql)
+
 
 def make_batch_limits(iterable, n):
     """Convert a sorted iterable into lower/upper values of batches of size n."""
@@ -131,39 +216,287 @@ def make_batch_limits(iterable, n):
         yield (chunk[0], chunk[-1] + 1)
 
 
-if __name__ == "__main__":
-    args = parse_args()
+def remaining_batch_limits(db_path, group_ids, batches):
+    """Filter out batches whose groups are all covered by recorded progress."""
+    with contextlib.closing(sqlite3.connect(db_path)) as conn, conn:
+        done = conn.execute("select lower, upper from recommendations_progress")
+        done = done.fetchall()
 
-    # get list of group IDs to insert
-    with sqlite3.connect(args.db_path) as conn:
-        max_group_id = conn.execute("select max(group_id) + 1 from groups").fetchone()[
-            0
-        ]
+    group_ids = np.asarray(group_ids)
+    is_done = np.zeros(len(group_ids), dtype=bool)
+    for lower, upper in done:
+        is_done[slice(*np.searchsorted(group_ids, (lower, upper)))] = True
 
-        sql = """
-            select group_id 
-            from groups 
-            where group_id >= ? and group_id < ?
-            order by 1
+    return [
+        (lower, upper)
+        for lower, upper in batches
+        if not is_done[slice(*np.searchsorted(group_ids, (lower, upper)))].all()
+    ]
+
+
+def connect_read_only(db_path: Path) -> sqlite3.Connection:
+    """Open a read only connection, which can run alongside the writer in WAL mode."""
+    return sqlite3.connect(f"{Path(db_path).resolve().as_uri()}?mode=ro", uri=True)
+
+
+def sql_params(lower: int, upper: int) -> dict:
+    """Get the parameters for a batch of APRIORI_SQL."""
+    return dict(
+        min_support=MIN_SUPPORT,
+        alpha=ALPHA,
+        beta=BETA,
+        lower=lower,
+        upper=upper,
+        n_candidates=N_CANDIDATES,
+    )
+
+
+class SnatchMatrix(typing.NamedTuple):
+    """In-memory copy of the snatches, restricted to groups with minimum support.
+
+    Columns of the matrices are the eligible groups in order of group_id.
+    """
+
+    group_ids: np.ndarray
+    artist_ids: np.ndarray
+    snatch_counts: np.ndarray
+    total_snatches: int
+    user_group: sparse.csr_matrix  # users x groups
+    group_user: sparse.csr_matrix  # groups x users
+
+
+def fetch_array(conn, sql: str, ncols: int, chunksize: int = 1000000) -> np.ndarray:
+    """Read a query of integers into an (n, ncols) array without a list of tuples."""
+    cursor = conn.execute(sql)
+    chunks = [np.empty((0, ncols), dtype=np.int64)]
+    while True:
+        rows = cursor.fetchmany(chunksize)
+        if not rows:
+            break
+        chunks.append(np.array(rows, dtype=np.int64).reshape(-1, ncols))
+    return np.concatenate(chunks)
+
+
+def load_snatch_matrix(conn) -> SnatchMatrix:
+    """Load snatches and groups from the database into sparse matrices."""
+    total_snatches = conn.execute("select count(*) from snatches").fetchone()[0]
+    groups = fetch_array(
+        conn,
         """
-        group_ids = [i for (i,) in conn.execute(sql, (1, max_group_id)).fetchall()]
+        select group_id, artist_id, snatch_count
+        from groups
+        where snatch_count >= %d
+        order by group_id
+        """
+        % MIN_SUPPORT,
+        3,
+    )
+    snatches = fetch_array(conn, "select user_id, group_id from snatches", 2)
+
+    # drop snatches of ineligible groups, they can't be referents or consequents.
+    group_ids = groups[:, 0]
+    snatches = snatches[np.isin(snatches[:, 1], group_ids)]
+    cols = np.searchsorted(group_ids, snatches[:, 1])
+    user_ids, rows = np.unique(snatches[:, 0], return_inverse=True)
+
+    user_group = sparse.csr_matrix(
+        (np.ones(len(rows), dtype=np.int32), (rows.ravel(), cols)),
+        shape=(len(user_ids), len(group_ids)),
+    )
+    return SnatchMatrix(
+        group_ids=group_ids,
+        artist_ids=groups[:, 1],
+        snatch_counts=groups[:, 2],
+        total_snatches=total_snatches,
+        user_group=user_group,
+        group_user=user_group.T.tocsr(),
+    )
+
+
+def score_pairs(
+    matrix: SnatchMatrix,
+    ref: np.ndarray,
+    con: np.ndarray,
+    count: np.ndarray,
+    total_snatches: int = None,
+) -> typing.Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Score referent, consequent column pairs with their co-occurrence counts.
+
+    Returns the relative lift, consequent support and lift, computed with the same
+    operations in the same order as the SQL so the floats are identical. The total
+    snatches default to those of the matrix.
+    """
+    if total_snatches is None:
+        total_snatches = matrix.total_snatches
+    consequent_support = (matrix.snatch_counts[con] + ALPHA) / (
+        total_snatches + ALPHA + BETA
+    )
+    lift = (
+        (count + ALPHA) / (matrix.snatch_counts[ref] + ALPHA + BETA)
+    ) / consequent_support
+    relative_lift = (count + ALPHA) / (matrix.snatch_counts[con] + ALPHA)
+    return relative_lift, consequent_support, lift
+
+
+def sparse_recommendations(
+    matrix: SnatchMatrix, referents: np.ndarray
+) -> typing.List[tuple]:
+    """Compute recommendation rows for referent column indices of the matrix.
+
+    Mirrors APRIORI_SQL: co-occurrence counts are the users in common, consequents
+    by the same artist are excluded, and candidates are ranked by lift, then
+    consequent support, then group_id.
+    """
+    cooccurrence = (matrix.group_user[referents] @ matrix.user_group).tocoo()
+    ref = referents[cooccurrence.row]
+    con = cooccurrence.col
+    count = cooccurrence.data
+
+    keep = (ref != con) & (matrix.artist_ids[ref] != matrix.artist_ids[con])
+    ref, con, count = ref[keep], con[keep], count[keep]
+
+    relative_lift, consequent_support, lift = score_pairs(matrix, ref, con, count)
+
+    keep = lift > 1
+    ref, con, count = ref[keep], con[keep], count[keep]
+    consequent_support, lift = consequent_support[keep], lift[keep]
+    relative_lift = relative_lift[keep]
+
+    # columns are in group_id order, so sorting by column breaks the final ties.
+    order = np.lexsort((con, -consequent_support, -relative_lift, ref))
+    ref, con, count = ref[order], con[order], count[order]
+    consequent_support, lift = consequent_support[order], lift[order]
+
+    # number the candidates within each referent, keep the top few.
+    starts = np.flatnonzero(np.r_[True, ref[1:] != ref[:-1]]) if len(ref) else ref
+    rank = np.arange(len(ref)) - np.repeat(starts, np.diff(np.r_[starts, len(ref)]))
+    keep = rank < N_CANDIDATES
+
+    return list(
+        zip(
+            matrix.group_ids[ref[keep]].tolist(),
+            matrix.group_ids[con[keep]].tolist(),
+            (rank[keep] + 1).tolist(),
+            count[keep].tolist(),
+            consequent_support[keep].tolist(),
+            lift[keep].tolist(),
+        )
+    )
+
+
+def sql_batch(db_path: Path, limits: typing.Tuple[int, int]):
+    """Compute recommendation rows for a batch of referents with APRIORI_SQL."""
+    with contextlib.closing(connect_read_only(db_path)) as conn:
+        rows = conn.execute(APRIORI_SQL, sql_params(*limits)).fetchall()
+    return limits, rows
+
+
+def sparse_batch(matrix: SnatchMatrix, limits: typing.Tuple[int, int]):
+    """Compute recommendation rows for a batch of referents from the matrix."""
+    lower, upper = np.searchsorted(matrix.group_ids, limits)
+    return limits, sparse_recommendations(matrix, np.arange(lower, upper))
+
 
-    rebuild_table(args.db_path)
+def write_batches(db_path: Path, results, total: int, resume: bool = False) -> None:
+    """Insert computed batches, recording each one as done in the same transaction.
 
-    batches = list(make_batch_limits(group_ids, args.batch))
-    for lower, upper in tqdm.tqdm(batches):
-        with sqlite3.connect(args.db_path) as conn:
-            conn.execute(APRIORI_SQL, (lower, upper))
+    results is an iterable of ((lower, upper), rows) in any order.
+    """
+    with contextlib.closing(sqlite3.connect(db_path)) as conn:
+        conn.execute("pragma journal_mode = wal")
+        for (lower, upper), rows in tqdm.tqdm(results, total=total):
+            with conn:
+                # partial results from another batch size could overlap this one.
+                if resume:
+                    sql_delete = """
+                    delete from recommendations
+                    where group_id >= ? and group_id < ?
+                    """
+                    conn.execute(sql_delete, (lower, upper))
+                conn.executemany(INSERT_SQL, rows)
+                conn.execute(
+                    "insert or ignore into recommendations_progress values (?, ?)",
+                    (lower, upper),
+                )
+
+        # back to a single file db, unless someone else has it open.
+        try:
+            conn.execute("pragma journal_mode = delete")
+        except sqlite3.OperationalError:
+            pass
+
+
+def run(
+    db_path: Path,
+    engine: str = "sql",
+    batch: int = 100,
+    workers: int = 1,
+    resume: bool = False,
+) -> None:
+    """Build the recommendations table."""
+    # get list of group IDs to insert
+    with contextlib.closing(sqlite3.connect(db_path)) as conn, conn:
+        sql = "select group_id from groups where group_id >= 1 order by 1"
+        group_ids = [i for (i,) in conn.execute(sql).fetchall()]
+
+    rebuild_table(db_path, resume=resume)
+    batches = list(make_batch_limits(group_ids, batch))
+    if resume:
+        batches = remaining_batch_limits(db_path, group_ids, batches)
+
+    if engine == "sparse":
+        with contextlib.closing(connect_read_only(db_path)) as conn:
+            matrix = load_snatch_matrix(conn)
+        results = map(functools.partial(sparse_batch, matrix), batches)
+        write_batches(db_path, results, len(batches), resume=resume)
+
+    elif workers > 1:
+        # the writer needs WAL mode on before the readers start.
+        with contextlib.closing(sqlite3.connect(db_path)) as conn, conn:
+            conn.execute("pragma journal_mode = wal")
+        with multiprocessing.Pool(workers) as pool:
+            results = pool.imap_unordered(
+                functools.partial(sql_batch, db_path), batches
+            )
+            write_batches(db_path, results, len(batches), resume=resume)
+
+    else:
+        results = map(functools.partial(sql_batch, db_path), batches)
+        write_batches(db_path, results, len(batches), resume=resume)
 
     # finish off with indexes
-    with sqlite3.connect(args.db_path) as conn:
+    make_indexes(db_path)
+
+
+def make_indexes(db_path: Path) -> None:
+    """Add indexes to the finished recommendations table."""
+    with contextlib.closing(sqlite3.connect(db_path)) as conn, conn:
         conn.execute(
             """
-            create unique index uidx 
+            create unique index if not exists uidx 
             on recommendations (group_id, recommendation_group_id)
             """
         )
-        conn.execute("""create index group_idx on recommendations (group_id)""")
         conn.execute(
-            """create index rgroup_idx on recommendations (recommendation_group_id)"""
+            """
+            create index if not exists group_idx
+            on recommendations (group_id)
+            """
+        )
+        conn.execute(
+            """
+            create index if not exists rgroup_idx
+            on recommendations (recommendation_group_id)
+            """
         )
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    run(
+        args.db_path,
+        engine=args.engine,
+        batch=args.batch,
+        workers=args.workers,
+        resume=args.resume,
+    )
@@ -6,18 +6,36 @@ $ python -m build.make_search_index mini.json.gz .whoosh_index
 
 Adding files should take a minute or two, commiting it all should take another few 
 minutes. On one run it took my machine 8 mins.
+
+Options to speed that up:
+
+--procs N uses N indexing processes, each writing its own segments.
+--lean stores only the fields search needs, for apps serving from the recommendation
+  store (see make_rec_store). The index is smaller and faster to write.
+--update updates an existing index in place, only rewriting changed documents.
+
+$ python -m build.make_search_index data.db .whoosh_index --procs 4 --lean
+$ python -m build.make_search_index data.db .whoosh_index --update
+
+It reports the docs/sec and the size of the index when done.
 """
 
 import argparse
+import contextlib
+import hashlib
 import sqlite3
+import time
+import typing
 from pathlib import Path
 
 import tqdm
-from whoosh.fields import NUMERIC, TEXT, Schema
-from whoosh.index import create_in
+from whoosh.fields import NUMERIC, STORED, TEXT, Schema
+from whoosh.index import create_in, open_dir
+
+from .make_recommendations import N_RECOMMENDATIONS
 
 # produces a schema like: group_id, artist_name, name, recommendations_str
-# with recommendations_str as a comma delimited string of group ints.
+# with recommendations_str as a comma delimited string of the top group ints.
 #
 # one could split and then integer the groups and then map back to the index.
 SQL = """
@@ -34,7 +52,12 @@ r as (
     select
         group_id,
         group_concat(recommendation_group_id, ',') as recommendations_str
-    from (select * from recommendations order by group_id, recommendation_number) as t
+    from (
+        select * 
+        from recommendations 
+        where recommendation_number <= :n_recommendations
+        order by group_id, recommendation_number
+    ) as t
     group by 1
 )
 
@@ -50,6 +73,122 @@ left join r
 """
 
 
+# restricts SQL to the groups in a temp table
+SQL_SOME_GROUPS = (
+    SQL
+    + """
+where g.group_id in (select group_id from temp.index_groups)
+"""
+)
+
+
+def read_rows(
+    conn: sqlite3.Connection, sql: str, chunksize: int = 10000
+) -> typing.Iterator[tuple]:
+    """Stream the rows of a query, fetching them in chunks."""
+    cursor = conn.execute(sql, dict(n_recommendations=N_RECOMMENDATIONS))
+    while True:
+        rows = cursor.fetchmany(chunksize)
+        if not rows:
+            return
+        yield from rows
+
+
+def make_schema(lean: bool = False) -> Schema:
+    """Get the schema of the index."""
+    if lean:
+        # just what search needs, everything else comes from the recommendation
+        # store. The digest is used to find changed documents when updating.
+        return Schema(
+            group_id=NUMERIC(stored=True),
+            name=TEXT,
+            artist_name=TEXT,
+            digest=STORED,
+        )
+
+    # storing EVERYTHIGN because the whole thing is running on this index.
+    return Schema(
+        group_id=NUMERIC(stored=True),
+        name=TEXT(stored=True),
+        artist_name=TEXT(stored=True),
+        recommendations_str=TEXT(stored=True),
+    )
+
+
+def make_document(schema: Schema, row: tuple) -> dict:
+    """Convert a row of SQL into a document for the schema."""
+    group_id, artist_name, name, recommendations_str = row
+    doc = dict(group_id=group_id, artist_name=artist_name, name=name)
+    if "recommendations_str" in schema:
+        doc["recommendations_str"] = recommendations_str
+    if "digest" in schema:
+        # only what the schema indexes, so new recommendations leave it unchanged
+        indexed = repr((group_id, name, artist_name)).encode()
+        doc["digest"] = hashlib.blake2b(indexed, digest_size=8).hexdigest()
+    return doc
+
+
+def stored_fields(schema: Schema, doc: dict) -> dict:
+    """Get the fields of a document which the index would store."""
+    return {k: v for k, v in doc.items() if v is not None and schema[k].stored}
+
+
+def index_size(index_path: Path) -> int:
+    """Get the size of the Whoosh files of the index on disk, in bytes.
+
+    Only the table of contents and segments are counted, not the sidecars such as the
+    recommendation store that may be written next to them.
+    """
+    files = [*index_path.glob("*.toc"), *index_path.glob("*.seg")]
+    return sum(i.stat().st_size for i in files)
+
+
+def update_index(
+    search_index, conn: sqlite3.Connection, group_ids=None, chunksize: int = 10000
+) -> int:
+    """Update an existing index in place with fresh rows.
+
+    Rows are compared against the stored fields of the index, only changed documents
+    are replaced, and documents of groups no longer in the database are deleted. If
+    group_ids are given, only those groups are compared. Returns the number of
+    documents written.
+    """
+    schema = search_index.schema
+    with search_index.searcher() as searcher:
+        if group_ids is None:
+            sql = SQL
+            existing = {i["group_id"]: i for i in searcher.all_stored_fields()}
+        else:
+            sql = SQL_SOME_GROUPS
+            group_ids = [int(i) for i in group_ids]
+            existing = {i: searcher.document(group_id=i) for i in group_ids}
+            existing = {k: v for k, v in existing.items() if v is not None}
+            conn.execute(
+                "create temp table if not exists index_groups (group_id integer)"
+            )
+            conn.execute("delete from temp.index_groups")
+            conn.executemany(
+                "insert into temp.index_groups values (?)", [(i,) for i in group_ids]
+            )
+
+    n = 0
+    # one searcher for all the deletes, rather than one opened per delete
+    with search_index.writer() as writer, writer.searcher() as searcher:
+        for row in read_rows(conn, sql, chunksize):
+            doc = make_document(schema, row)
+            old = existing.pop(doc["group_id"], None)
+            if old == stored_fields(schema, doc):
+                continue
+            if old is not None:
+                writer.delete_by_term("group_id", doc["group_id"], searcher=searcher)
+            writer.add_document(**doc)
+            n += 1
+
+        for group_id in existing:
+            writer.delete_by_term("group_id", group_id, searcher=searcher)
+    return n
+
+
 def parse_args():
     """Parse CLI args."""
     p = argparse.ArgumentParser(
@@ -65,35 +204,73 @@ def parse_args():
     p.add_argument(
         "--memory", type=int, default=256, help="Memory limit (mb) for indexing.",
     )
+    p.add_argument(
+        "--procs", type=int, default=1, help="Number of indexing processes.",
+    )
+    p.add_argument(
+        "--chunk", type=int, default=10000, help="Rows to fetch from sqlite at once.",
+    )
+    p.add_argument(
+        "--lean",
+        action="store_true",
+        default=False,
+        help="Only store the fields search needs. Requires the recommendation store.",
+    )
+    p.add_argument(
+        "--update",
+        action="store_true",
+        default=False,
+        help="Update changed documents of an existing index, keeping its schema.",
+    )
     return p.parse_args()
 
 
-if __name__ == "__main__":
-    args = parse_args()
+def make_index(
+    db_path: Path,
+    index_path: Path,
+    memory: int = 256,
+    procs: int = 1,
+    chunksize: int = 10000,
+    lean: bool = False,
+) -> int:
+    """Create the index from scratch, returning the number of documents."""
+    if not index_path.exists():
+        index_path.mkdir()
 
-    if not args.index_path.exists():
-        args.index_path.mkdir()
+    schema = make_schema(lean=lean)
+    search_index = create_in(index_path, schema)
+    writer_args = dict(limitmb=memory, multisegment=True)
+    if procs > 1:
+        writer_args["procs"] = procs
 
-    # storing EVERYTHIGN because the whole thing is running on this index.
-    schema = Schema(
-        group_id=NUMERIC(stored=True),
-        name=TEXT(stored=True),
-        artist_name=TEXT(stored=True),
-        recommendations_str=TEXT(stored=True),
-    )
-    search_index = create_in(args.index_path, schema)
-
-    with sqlite3.connect(args.db_path) as conn, search_index.writer(
-        limitmb=args.memory, multisegment=True
+    with contextlib.closing(sqlite3.connect(db_path)) as conn, search_index.writer(
+        **writer_args
     ) as writer:
 
         n = conn.execute("select count(*) from groups").fetchall()[0][0]
-        res = conn.execute(SQL)
-
-        for group_id, artist_name, name, recommendations_str in tqdm.tqdm(res, total=n):
-            writer.add_document(
-                group_id=group_id,
-                artist_name=artist_name,
-                name=name,
-                recommendations_str=recommendations_str,
-            )
+        for row in tqdm.tqdm(read_rows(conn, SQL, chunksize), total=n):
+            writer.add_document(**make_document(schema, row))
+
+    return n
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    start = time.perf_counter()
+    if args.update:
+        with contextlib.closing(sqlite3.connect(args.db_path)) as conn:
+            n = update_index(open_dir(args.index_path), conn, chunksize=args.chunk)
+    else:
+        n = make_index(
+            args.db_path,
+            args.index_path,
+            memory=args.memory,
+            procs=args.procs,
+            chunksize=args.chunk,
+            lean=args.lean,
+        )
+    seconds = time.perf_counter() - start
+
+    print(f"Wrote {n} documents in {seconds:.1f}s ({n / seconds:.0f} docs/sec).")
+    print(f"Index size: {index_size(args.index_path) / 2**20:.1f} MB.")
@@ -0,0 +1,127 @@
+"""Export a prefix index of album and artist names for typeahead suggestions.
+
+The app maps the index at startup and uses it to answer /api/suggest. See
+app.suggest for the file layout. Only groups with recommendations are suggested, so
+run this after make_recommendations.
+
+Use like:
+
+$ python -m build.make_suggest_index data.db .whoosh_index/suggest.bin
+
+The app looks for the index in the whoosh index directory, so it ships along with
+the index.
+"""
+
+import argparse
+import bisect
+import contextlib
+import sqlite3
+import typing
+from pathlib import Path
+
+import numpy as np
+import tqdm
+
+from app.store import write_arrays
+from app.suggest import (
+    N_SUGGESTIONS,
+    SHORT_PREFIX_LENGTH,
+    best_rows,
+    normalize,
+    word_keys,
+)
+
+from .make_rec_store import StringTable, encode_strings
+
+GROUPS_SQL = """
+select
+    group_id,
+    groups.name,
+    artists.name as artist_name,
+    groups.snatch_count
+from groups
+inner join artists on groups.artist_id = artists.artist_id
+where exists (
+    select 1 from recommendations where recommendations.group_id = groups.group_id
+)
+order by group_id
+"""
+
+
+def parse_args():
+    """Parse CLI args."""
+    p = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    p.add_argument(
+        "db_path", type=Path, help="Path to the sqlite data.",
+    )
+    p.add_argument(
+        "suggest_path", type=Path, help="Path to save the suggest index.",
+    )
+    return p.parse_args()
+
+
+def make_suggest_arrays(
+    conn: sqlite3.Connection, k: int = N_SUGGESTIONS
+) -> typing.Dict[str, np.ndarray]:
+    """Read the groups into the suggest index arrays."""
+    strings = StringTable()
+    group_ids, names, artist_names, entries = [], [], [], []
+    for row, (group_id, name, artist_name, snatch_count) in enumerate(
+        conn.execute(GROUPS_SQL)
+    ):
+        group_ids.append(group_id)
+        names.append(strings.add(name))
+        artist_names.append(strings.add(artist_name))
+
+        keys = set(word_keys(normalize(name)) + word_keys(normalize(artist_name)))
+        entries.extend((key.encode(), row, snatch_count) for key in keys)
+
+    entries.sort()
+    keys = [key for key, _, _ in entries]
+    key_row = np.array([row for _, row, _ in entries], dtype=np.int32)
+    key_score = np.array([score for _, _, score in entries], dtype=np.int64)
+
+    # precompute the best groups of short prefixes, which match many keys
+    # normalized queries never end in a space, so neither do the prefixes
+    prefixes = {
+        key.decode()[:n] for key in keys for n in range(1, SHORT_PREFIX_LENGTH + 1)
+    }
+    prefixes = sorted(i.encode() for i in prefixes if not i.endswith(" "))
+    top_rows = np.full((len(prefixes), k), -1, dtype=np.int32)
+    for i, prefix in enumerate(tqdm.tqdm(prefixes)):
+        lo = bisect.bisect_left(keys, prefix)
+        hi = bisect.bisect_left(keys, prefix + b"\xff", lo)
+        rows = best_rows(key_row[lo:hi], key_score[lo:hi], k)
+        top_rows[i, : len(rows)] = rows
+
+    key_offsets, key_data = encode_strings(keys)
+    top_offsets, top_data = encode_strings(prefixes)
+    string_offsets, string_data = strings.arrays()
+    return dict(
+        group_id=np.array(group_ids, dtype=np.int32),
+        name=np.array(names, dtype=np.int32),
+        artist_name=np.array(artist_names, dtype=np.int32),
+        key_offsets=key_offsets,
+        keys=key_data,
+        key_row=key_row,
+        key_score=key_score,
+        top_offsets=top_offsets,
+        top_prefixes=top_data,
+        top_rows=top_rows,
+        string_offsets=string_offsets,
+        strings=string_data,
+    )
+
+
+def make_suggest_index(db_path: Path, suggest_path: Path) -> None:
+    """Export the database into a suggest index file."""
+    with contextlib.closing(sqlite3.connect(db_path)) as conn:
+        arrays = make_suggest_arrays(conn)
+    write_arrays(suggest_path, arrays)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    make_suggest_index(args.db_path, args.suggest_path)
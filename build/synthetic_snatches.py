@@ -0,0 +1,161 @@
+"""Generate synthetic user snatches, for benchmarks.
+
+Writes a file in the same one JSON payload per line format as user_snatches, so the
+rest of the build can run on it. Group popularity follows a power law: the i-th most
+popular group is snatched in proportion to 1 / i ** skew. Albums are spread over
+artists by another power law, so that a few artists have many albums. The number of
+snatches per user is geometric, so most users snatch a little and a few a lot.
+
+Use like:
+
+$ python -m build.synthetic_snatches users.json --users 100000 --groups 50000
+
+A small share of the lines are failed requests, missing users and hidden profiles,
+and a small share of the snatches are compilations without an artist, as in a real
+scrape. Some names have an ampersand or quotes, which the API escapes.
+"""
+
+import argparse
+import html
+import json
+import typing
+from pathlib import Path
+
+import numpy as np
+import tqdm
+
+SYLLABLES = (
+    "ka lo mi ne ru sa to vi zen dor bel ash mon "
+    "tri qua ex ul ory phi gra sol wen yth jo"
+).split()
+
+
+def parse_args():
+    """Parse CLI args."""
+    p = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    p.add_argument("output_path", type=Path, help="Path to save the JSON data.")
+    p.add_argument("--users", type=int, default=10000, help="Number of users.")
+    p.add_argument("--groups", type=int, default=5000, help="Number of groups.")
+    p.add_argument("--artists", type=int, default=1000, help="Number of artists.")
+    p.add_argument(
+        "--skew", type=float, default=1.0, help="Power law exponent of popularity."
+    )
+    p.add_argument(
+        "--mean-snatches", type=float, default=30.0, help="Mean snatches per user."
+    )
+    p.add_argument(
+        "--error-rate", type=float, default=0.05, help="Share of unusable lines."
+    )
+    p.add_argument("--seed", type=int, default=0, help="Random seed.")
+    return p.parse_args()
+
+
+def make_name(rng: np.random.Generator, n_words: int) -> str:
+    """Make up a name of a few words, some with an ampersand or quotes."""
+    words = []
+    for _ in range(n_words):
+        syllables = rng.choice(SYLLABLES, size=rng.integers(1, 4))
+        words.append("".join(syllables).capitalize())
+    roll = rng.random()
+    if roll < 0.1:
+        words.insert(len(words) // 2, "&")
+    elif roll < 0.2:
+        words[-1] = f'"{words[-1]}"'
+    return " ".join(words)
+
+
+def power_law(n: int, skew: float) -> np.ndarray:
+    """Probabilities of n items, the i-th in proportion to 1 / i ** skew."""
+    weights = 1.0 / np.arange(1, n + 1) ** skew
+    return weights / weights.sum()
+
+
+def generate_lines(
+    n_users: int = 10000,
+    n_groups: int = 5000,
+    n_artists: int = 1000,
+    skew: float = 1.0,
+    mean_snatches: float = 30.0,
+    error_rate: float = 0.05,
+    seed: int = 0,
+    first_user: int = 1,
+    first_group: int = 1,
+    first_artist: int = 1,
+) -> typing.Iterator[str]:
+    """Generate synthetic user_snatches lines, one per user.
+
+    IDs count up from the first ones, so that lines of new users, groups and
+    artists can be generated for an existing scrape.
+    """
+    rng = np.random.default_rng(seed)
+    artist_names = [make_name(rng, rng.integers(1, 3)) for _ in range(n_artists)]
+    group_names = [make_name(rng, rng.integers(1, 4)) for _ in range(n_groups)]
+    group_artists = rng.choice(n_artists, size=n_groups, p=power_law(n_artists, skew))
+
+    # group ids are shuffled, so popularity is not in id order
+    group_ids = rng.permutation(n_groups) + first_group
+    popularity = np.cumsum(power_law(n_groups, skew))
+
+    for user_id in range(first_user, first_user + n_users):
+        roll = rng.random()
+        if roll < error_rate / 3:
+            payload = dict(user_id=user_id, failed=True, data=dict())
+        elif roll < error_rate * 2 / 3:
+            payload = dict(
+                user_id=user_id,
+                failed=False,
+                data=dict(status="failure", error="no such user"),
+            )
+        elif roll < error_rate:
+            payload = dict(
+                user_id=user_id,
+                failed=False,
+                data=dict(status="success", response=dict(snatched="hidden")),
+            )
+        else:
+            k = min(rng.geometric(1 / mean_snatches), n_groups)
+            # sampling from the cdf, as rng.choice(p=...) rebuilds it every call
+            groups = np.unique(
+                np.searchsorted(popularity, rng.random(k) * popularity[-1])
+            )
+            snatched = [
+                dict(
+                    groupId=int(group_ids[g]),
+                    name=html.escape(group_names[g]),
+                    artistId=int(group_artists[g]) + first_artist,
+                    artistName=html.escape(artist_names[group_artists[g]]),
+                )
+                for g in groups.tolist()
+            ]
+            if rng.random() < error_rate:
+                snatched.append(dict(groupId=0, name="Various Artists"))
+            payload = dict(
+                user_id=user_id,
+                failed=False,
+                data=dict(status="success", response=dict(snatched=snatched)),
+            )
+        yield json.dumps(payload)
+
+
+def write_lines(output_path: Path, **kwargs) -> None:
+    """Write synthetic user_snatches lines to a file."""
+    with output_path.open("w") as f:
+        for line in tqdm.tqdm(generate_lines(**kwargs), total=kwargs.get("n_users")):
+            f.write(line)
+            f.write("\n")
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    write_lines(
+        args.output_path,
+        n_users=args.users,
+        n_groups=args.groups,
+        n_artists=args.artists,
+        skew=args.skew,
+        mean_snatches=args.mean_snatches,
+        error_rate=args.error_rate,
+        seed=args.seed,
+    )
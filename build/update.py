@@ -0,0 +1,347 @@
+"""Merge newly scraped users into an existing build, redoing only what changed.
+
+Rather than rebuilding the database, recommendations and search index from scratch,
+this merges the new JSON into the database, recomputes recommendations only for the
+groups whose scores could have changed, and replaces only their documents in the
+search index. The result is the same as a full rebuild with the new JSON appended to
+the old.
+
+Use like:
+
+$ python -m build.update new_users.json data.db .whoosh_index
+
+Pass --store and --suggest to also re-export the recommendation store and the
+suggest index.
+
+Which groups are recomputed? Candidates are ranked by relative lift, which depends on
+the co-occurrence count of a pair and the snatch count of the candidate. Only the
+groups in the new JSON have new counts, so they are recomputed, as are the groups
+whose candidates among them moved or dropped out, and those one of them ranks into.
+The total snatches only raise the lifts of the rest, which can lift new candidates
+above 1; so groups with fewer than N_CANDIDATES candidates are recomputed if they
+have a new one. The rest have their scores updated in place from the stored support.
+"""
+
+import argparse
+import contextlib
+import sqlite3
+import typing
+from pathlib import Path
+
+import numpy as np
+import tqdm
+from whoosh.index import open_dir
+
+from . import (
+    make_rec_store,
+    make_recommendations,
+    make_search_index,
+    make_sqlite,
+    make_suggest_index,
+)
+
+# scores from stored supports, same operations as APRIORI_SQL
+RESCORE_SQL = """
+update recommendations set
+    consequent_support = (
+        select (snatch_count + :alpha) / (:total_snatches + :alpha + :beta)
+        from groups
+        where groups.group_id = recommendations.recommendation_group_id
+    ),
+    lift = (
+        (support + :alpha) / (
+            select snatch_count + :alpha + :beta
+            from groups
+            where groups.group_id = recommendations.group_id
+        )
+    ) / (
+        select (snatch_count + :alpha) / (:total_snatches + :alpha + :beta)
+        from groups
+        where groups.group_id = recommendations.recommendation_group_id
+    )
+"""
+
+
+def parse_args():
+    """Parse CLI args."""
+    p = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    p.add_argument(
+        "json_path", type=Path, help="Path to the newly scraped JSON data.",
+    )
+    p.add_argument(
+        "db_path", type=Path, help="Path to the existing SQLite DB.",
+    )
+    p.add_argument(
+        "index_path", type=Path, help="Path to the existing search index.",
+    )
+    p.add_argument(
+        "--store", type=Path, help="Path to re-export the recommendation store to.",
+    )
+    p.add_argument(
+        "--suggest", type=Path, help="Path to re-export the suggest index to.",
+    )
+    p.add_argument(
+        "--workers", type=int, default=1, help="Number of processes parsing lines.",
+    )
+    p.add_argument(
+        "--batch", type=int, default=1000, help="Groups per recommendation batch.",
+    )
+    return p.parse_args()
+
+
+def merge_json(db_path: Path, json_path: Path, workers: int = 1) -> typing.Set[int]:
+    """Merge scraped JSON into the database, returning the group IDs it touched."""
+    touched = set()
+    make_sqlite.bulk_load(
+        db_path,
+        json_path,
+        workers=workers,
+        pragmas="",
+        on_insert=lambda item: touched.update(group_id for group_id, _, _ in item[2]),
+    )
+    return touched
+
+
+def stored_lists(conn: sqlite3.Connection) -> np.ndarray:
+    """Get the length and last kept candidate of every stored candidate list.
+
+    Returns rows of group_id, count, last candidate group_id and its support.
+    """
+    # sqlite takes the bare columns from the row with the max
+    sql = """
+    select
+        group_id,
+        max(recommendation_number),
+        recommendation_group_id,
+        support
+    from recommendations
+    group by group_id
+    order by group_id
+    """
+    return make_recommendations.fetch_array(conn, sql, 4)
+
+
+def dirty_referents(
+    conn: sqlite3.Connection,
+    matrix: make_recommendations.SnatchMatrix,
+    touched: typing.Set[int],
+) -> np.ndarray:
+    """Get the group IDs whose recommendations need to be recomputed.
+
+    Those are the touched groups, and the groups whose list of candidates could
+    have changed: those whose touched candidates moved or dropped out, those a
+    touched group now ranks into, and those without a full list which have a new
+    candidate.
+    """
+    mr = make_recommendations
+    n_groups = len(matrix.group_ids)
+    is_touched = np.isin(matrix.group_ids, np.array(sorted(touched), dtype=np.int64))
+    dirty = is_touched.copy()
+
+    # stored candidate lists, by column. Ineligible groups have none.
+    lists = stored_lists(conn)
+    lists = lists[np.isin(lists[:, 0], matrix.group_ids)]
+    rows = np.searchsorted(matrix.group_ids, lists[:, 0])
+    count = np.zeros(n_groups, dtype=np.int64)
+    count[rows] = lists[:, 1]
+
+    full = np.zeros(n_groups, dtype=bool)
+    full[rows] = lists[:, 1] >= mr.N_CANDIDATES
+
+    # lists with a touched candidate, which may have moved or dropped out. If it
+    # was last in a full list, a candidate which is not stored may now beat it.
+    sql = """
+    select group_id, recommendation_group_id, support
+    from recommendations
+    where group_id in (
+        select group_id
+        from recommendations
+        where recommendation_group_id in (select group_id from temp.touched_groups)
+    )
+    order by group_id, recommendation_number
+    """
+    stored = mr.fetch_array(conn, sql, 3)
+    stored = stored[np.isin(stored[:, 0], matrix.group_ids)]
+    ref = np.searchsorted(matrix.group_ids, stored[:, 0])
+    con = np.searchsorted(matrix.group_ids, stored[:, 1])
+    relative_lift, consequent_support, lift = mr.score_pairs(
+        matrix, ref, con, stored[:, 2]
+    )
+    invalid = (lift <= 1) | (matrix.artist_ids[ref] == matrix.artist_ids[con])
+    dirty[ref[invalid]] = True
+
+    # still ranked in the stored order, relative to the next candidate
+    same = ref[:-1] == ref[1:]
+    ordered = (relative_lift[:-1] > relative_lift[1:]) | (
+        (relative_lift[:-1] == relative_lift[1:])
+        & (
+            (consequent_support[:-1] > consequent_support[1:])
+            | (
+                (consequent_support[:-1] == consequent_support[1:])
+                & (con[:-1] < con[1:])
+            )
+        )
+    )
+    dirty[ref[:-1][same & ~ordered]] = True
+
+    is_last = np.r_[~same, True] if len(ref) else ref.astype(bool)
+    dirty[ref[is_last & is_touched[con] & full[ref]]] = True
+
+    # otherwise only candidates and scores of touched groups changed, the rest
+    # keep their relative lift and rise in lift with the total.
+    def candidates(referents: np.ndarray, transpose: bool = False):
+        """Get the valid candidates of referent columns, with their scores.
+
+        If transposed, the columns are taken as consequents instead.
+        """
+        products = (matrix.group_user[referents] @ matrix.user_group).tocoo()
+        ref, con = referents[products.row], products.col
+        if transpose:
+            ref, con = con, ref
+        keep = (ref != con) & (matrix.artist_ids[ref] != matrix.artist_ids[con])
+        ref, con, support = ref[keep], con[keep], products.data[keep]
+        relative_lift, consequent_support, lift = mr.score_pairs(
+            matrix, ref, con, support
+        )
+        keep = lift > 1
+        return ref[keep], con[keep], relative_lift[keep], consequent_support[keep]
+
+    # full lists gain a touched group which beats their last kept candidate
+    ref, con, relative_lift, consequent_support = candidates(
+        np.flatnonzero(is_touched), transpose=True
+    )
+    keep = full[ref] & ~dirty[ref]
+    ref, con = ref[keep], con[keep]
+    relative_lift, consequent_support = relative_lift[keep], consequent_support[keep]
+
+    last = np.zeros(n_groups, dtype=np.int64)
+    last_support = np.zeros(n_groups, dtype=np.int64)
+    last_rows = np.isin(lists[:, 2], matrix.group_ids)
+    last[rows[last_rows]] = np.searchsorted(matrix.group_ids, lists[last_rows, 2])
+    last_support[rows[last_rows]] = lists[last_rows, 3]
+    last_relative_lift, last_consequent_support, _ = mr.score_pairs(
+        matrix, ref, last[ref], last_support[ref]
+    )
+    beats = (relative_lift > last_relative_lift) | (
+        (relative_lift == last_relative_lift)
+        & (
+            (consequent_support > last_consequent_support)
+            | ((consequent_support == last_consequent_support) & (con < last[ref]))
+        )
+    )
+    dirty[ref[beats]] = True
+
+    # short lists gain any new candidate, as lifts rise with the total
+    short = np.flatnonzero((count < mr.N_CANDIDATES) & ~dirty)
+    ref, _, _, _ = candidates(short)
+    n_candidates = np.bincount(ref, minlength=n_groups)
+    dirty[short] = np.minimum(n_candidates[short], mr.N_CANDIDATES) != count[short]
+
+    return matrix.group_ids[dirty]
+
+
+def refresh_recommendations(db_path: Path, touched: typing.Set[int], batch: int = 1000):
+    """Recompute recommendations of dirty groups and rescore the rest.
+
+    Returns the group IDs which were recomputed.
+    """
+    mr = make_recommendations
+    with contextlib.closing(sqlite3.connect(db_path)) as conn:
+        matrix = mr.load_snatch_matrix(conn)
+        conn.execute("create temp table touched_groups (group_id integer)")
+        conn.executemany(
+            "insert into temp.touched_groups values (?)", [(i,) for i in touched]
+        )
+        dirty = dirty_referents(conn, matrix, touched)
+
+        with conn:
+            conn.execute("create temp table dirty_groups (group_id integer)")
+            conn.executemany(
+                "insert into temp.dirty_groups values (?)",
+                [(i,) for i in dirty.tolist()],
+            )
+            sql = """
+            delete from recommendations
+            where group_id in (select group_id from temp.dirty_groups)
+            """
+            conn.execute(sql)
+
+            # everything left only needs new scores
+            params = dict(
+                alpha=mr.ALPHA, beta=mr.BETA, total_snatches=matrix.total_snatches
+            )
+            conn.execute(RESCORE_SQL, params)
+
+            referents = np.flatnonzero(np.isin(matrix.group_ids, dirty))
+            for ndx in tqdm.tqdm(range(0, len(referents), batch)):
+                rows = mr.sparse_recommendations(matrix, referents[ndx : ndx + batch])
+                conn.executemany(mr.INSERT_SQL, rows)
+
+    return dirty
+
+
+def reindex_groups(db_path: Path, touched: typing.Set[int], dirty: np.ndarray):
+    """Get the groups whose search documents could have changed.
+
+    Those are the groups with new recommendations, and the groups whose name or
+    artist name could have changed. update_index only rewrites those which did.
+    """
+    with contextlib.closing(sqlite3.connect(db_path)) as conn:
+        conn.execute("create temp table touched_groups (group_id integer)")
+        conn.executemany(
+            "insert into temp.touched_groups values (?)", [(i,) for i in touched]
+        )
+        sql = """
+        select group_id
+        from groups
+        where artist_id in (
+            select artist_id
+            from groups
+            where group_id in (select group_id from temp.touched_groups)
+        )
+        """
+        renamed = [i for (i,) in conn.execute(sql)]
+    return np.union1d(dirty, renamed)
+
+
+def update(
+    json_path: Path,
+    db_path: Path,
+    index_path: Path,
+    store_path: Path = None,
+    suggest_path: Path = None,
+    workers: int = 1,
+    batch: int = 1000,
+) -> np.ndarray:
+    """Run the whole incremental update, returning the recomputed group IDs."""
+    touched = merge_json(db_path, json_path, workers=workers)
+    dirty = refresh_recommendations(db_path, touched, batch=batch)
+
+    with contextlib.closing(sqlite3.connect(db_path)) as conn:
+        make_search_index.update_index(
+            open_dir(index_path), conn, reindex_groups(db_path, touched, dirty)
+        )
+
+    if store_path is not None:
+        make_rec_store.make_store(db_path, store_path)
+
+    if suggest_path is not None:
+        make_suggest_index.make_suggest_index(db_path, suggest_path)
+
+    return dirty
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    dirty = update(
+        args.json_path,
+        args.db_path,
+        args.index_path,
+        store_path=args.store,
+        suggest_path=args.suggest,
+        workers=args.workers,
+        batch=args.batch,
+    )
+    print(f"Recomputed recommendations for {len(dirty)} groups.")
@@ -13,23 +13,41 @@ $ python -m build.user_snatches 1 100 users.json
 That invocation would grab the data for all users with IDs between 1 and 100 
 (inclusive), then save to the specified file. The file will have one JSON payload per 
 line.
+
+Passing --concurrency switches to an asyncio scraper, which keeps that many requests in
+flight over a shared connection pool. Requests are spaced by a token bucket at --rate
+per second instead of sleeping after each one, and failed requests are retried with
+exponential backoff and jitter. With --resume, users already in the file are skipped.
+The rate is not scaled with the concurrency: raise --rate too, as far as the API
+allows, or the extra requests in flight just wait on the limiter.
+
+$ python -m build.user_snatches 1 50000 users.json --concurrency 8 --rate 2 --resume
 """
 import argparse
+import asyncio
 import json
 import os
+import random
 import sys
 import time
 import typing
 from pathlib import Path
 
+import aiohttp
 import requests
 import tqdm
 
-API_URL = os.environ["API_URL"]
-API_KEY = os.environ["API_KEY"]
+API_URL = os.getenv("API_URL")
+API_KEY = os.getenv("API_KEY")
 TIMEOUT_SECONDS = 2.0
 GET_ATTEMPTS = 100
 
+# for the async scraper
+BACKOFF_SECONDS = 1.0
+MAX_BACKOFF_SECONDS = 60.0
+REQUEST_TIMEOUT_SECONDS = 600.0
+WRITE_BUFFER_BYTES = 2**20
+
 
 def get_user_snatches(user_id: int):
     """Get snatched data for a user ID.
@@ -67,6 +85,136 @@ def get_user_snatches(user_id: int):
     return dict(user_id=user_id, failed=False, data=data)
 
 
+class TokenBucket:
+    """Rate limiter for coroutines sharing a request budget.
+
+    Tokens refill continuously at `rate` per second, up to `capacity`. Each request
+    takes one token, waiting for it if the bucket is empty.
+    """
+
+    def __init__(self, rate: float, capacity: float = 1.0):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def refill(self) -> None:
+        """Add the tokens accrued since the last refill."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self) -> None:
+        """Wait for and take a token."""
+        async with self.lock:
+            self.refill()
+            while self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                self.refill()
+            self.tokens -= 1
+
+
+def backoff_seconds(attempt: int, base: float = BACKOFF_SECONDS) -> float:
+    """Exponential backoff with full jitter for a zero-indexed retry attempt."""
+    return random.uniform(0, min(MAX_BACKOFF_SECONDS, base * 2**attempt))
+
+
+async def fetch_user_snatches(
+    session: aiohttp.ClientSession,
+    limiter: TokenBucket,
+    user_id: int,
+    api_url: str = API_URL,
+    attempts: int = GET_ATTEMPTS,
+    backoff: float = BACKOFF_SECONDS,
+) -> dict:
+    """Get snatched data for a user ID with a shared session.
+
+    Returns the same payloads as get_user_snatches.
+    """
+    params = dict(
+        action="user_torrents", id=user_id, type="snatched", limit=10000000000
+    )
+    for attempt in range(attempts):
+        await limiter.acquire()
+        try:
+            async with session.get(api_url, params=params) as r:
+                content = await r.text()
+
+                # invalid user raises HTTP error, so exit early.
+                if "no such user" not in content:
+                    r.raise_for_status()
+            # a truncated or error page body is retried like an HTTP error.
+            return dict(user_id=user_id, failed=False, data=json.loads(content))
+        except (aiohttp.ClientError, asyncio.TimeoutError, json.JSONDecodeError):
+            if attempt + 1 < attempts:
+                await asyncio.sleep(backoff_seconds(attempt, backoff))
+    return dict(user_id=user_id, failed=True, data=dict())
+
+
+def scraped_user_ids(filepath: Path) -> typing.Set[int]:
+    """Get the user IDs successfully scraped into a file.
+
+    A partial line left at the end of the file by a crash is cut off, so that
+    appending to the file starts on a new line.
+    """
+    if not filepath.exists():
+        return set()
+
+    user_ids = set()
+    with filepath.open("rb+") as fh:
+        end = 0
+        for line in fh:
+            if not line.endswith(b"\n"):
+                fh.truncate(end)
+                break
+            end += len(line)
+            data = json.loads(line)
+            if not data["failed"]:
+                user_ids.add(data["user_id"])
+    return user_ids
+
+
+async def scrape(
+    user_ids: typing.Sequence[int],
+    filepath: Path,
+    api_url: str = API_URL,
+    api_key: str = API_KEY,
+    rate: float = 1 / TIMEOUT_SECONDS,
+    burst: float = 1.0,
+    concurrency: int = 4,
+    attempts: int = GET_ATTEMPTS,
+    backoff: float = BACKOFF_SECONDS,
+) -> None:
+    """Scrape users concurrently, appending the payloads to a file as they finish.
+
+    Lines are written in order of completion rather than user ID.
+    """
+    limiter = TokenBucket(rate, capacity=burst)
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    timeout = aiohttp.ClientTimeout(total=REQUEST_TIMEOUT_SECONDS)
+    remaining = iter(user_ids)
+
+    async with aiohttp.ClientSession(
+        connector=connector, timeout=timeout, headers={"Authorization": api_key}
+    ) as session:
+        with filepath.open("a", buffering=WRITE_BUFFER_BYTES) as fh, tqdm.tqdm(
+            total=len(user_ids)
+        ) as progress:
+
+            async def worker():
+                # the iterator is shared, each user goes to the first free worker.
+                for user_id in remaining:
+                    data = await fetch_user_snatches(
+                        session, limiter, user_id, api_url, attempts, backoff
+                    )
+                    fh.write(json.dumps(data))
+                    fh.write("\n")
+                    progress.update()
+
+            await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+
 def parse_args():
     """Parse CLI args."""
     p = argparse.ArgumentParser(
@@ -92,7 +240,36 @@ def parse_args():
         default=False,
         help="Option to disable prompt on overwrite.",
     )
-    return p.parse_args()
+    p.add_argument(
+        "--concurrency",
+        type=int,
+        help="Use the async scraper with this many requests in flight.",
+    )
+    p.add_argument(
+        "--rate",
+        type=float,
+        default=1 / TIMEOUT_SECONDS,
+        help="Async scraper requests per second, whatever the concurrency. "
+        "default %(default)s.",
+    )
+    p.add_argument(
+        "--burst",
+        type=float,
+        default=1.0,
+        help="Async scraper requests allowed in a burst. default %(default)s.",
+    )
+    p.add_argument(
+        "--resume",
+        action="store_true",
+        default=False,
+        help="Append to the file, skipping users already in it. Implies --append.",
+    )
+    args = p.parse_args()
+    if API_URL is None or API_KEY is None:
+        p.error("export API_URL and API_KEY first.")
+    if args.resume:
+        args.append = True
+    return args
 
 
 #  do it
@@ -112,9 +289,26 @@ if __name__ == "__main__":
     if not args.append:
         args.filepath.write_text("")
 
+    user_ids = range(args.start_id, args.end_id + 1)
+    if args.resume:
+        done = scraped_user_ids(args.filepath)
+        user_ids = [i for i in user_ids if i not in done]
+
     # do the scraping
-    for user_id in tqdm.tqdm(range(args.start_id, args.end_id + 1)):
-        data = get_user_snatches(user_id)
+    if args.concurrency:
+        asyncio.run(
+            scrape(
+                user_ids,
+                args.filepath,
+                rate=args.rate,
+                burst=args.burst,
+                concurrency=args.concurrency,
+            )
+        )
+    else:
         with args.filepath.open("a") as fh:
-            fh.write(json.dumps(data))
-            fh.write("\n")
+            for user_id in tqdm.tqdm(user_ids):
+                data = get_user_snatches(user_id)
+                fh.write(json.dumps(data))
+                fh.write("\n")
+                fh.flush()
@@ -22,8 +22,10 @@ def create_app(config_file: str = "config.py"):
     if config_file:
         app.config.from_pyfile(config_file)
 
-    from . import routes
+    from . import metrics, routes
 
+    # before the limiter, so limited requests are timed too
+    metrics.init_app(app)
     limiter.init_app(app)
     app.register_blueprint(routes.bp)
 
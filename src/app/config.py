@@ -3,11 +3,21 @@
 import os
 from pathlib import Path
 
-from whoosh.index import open_dir
-from whoosh.qparser import MultifieldParser, OrGroup
+from app.search import SearchIndex
+from app.store import RecommendationStore
 
+# the index is opened on first use, and swapped when a new build is deployed. Point
+# this at a symlink or a directory of versioned builds to deploy without a restart.
 WHOOSH_INDEX_DIR = Path(os.getenv("WHOOSH_INDEX_DIR", "whoosh_index"))
-SEARCH_INDEX = open_dir(WHOOSH_INDEX_DIR)
-QUERY_PARSER = MultifieldParser(
-    ["name", "artist_name"], SEARCH_INDEX.schema, group=OrGroup.factory(0.9)
+SEARCH_INDEX = SearchIndex(
+    WHOOSH_INDEX_DIR,
+    cache_size=int(os.getenv("SEARCH_CACHE_SIZE", "4096")),
+    cache_ttl=float(os.getenv("SEARCH_CACHE_TTL", "3600")),
+    check_interval=float(os.getenv("SEARCH_CHECK_INTERVAL", "5")),
 )
+
+# recommendations are served from the store if there is one, else from the index.
+# By default that is the store in the index directory, which is swapped along with
+# the index. Set REC_STORE_PATH to use a fixed store instead.
+REC_STORE_PATH = os.getenv("REC_STORE_PATH")
+REC_STORE = RecommendationStore.open(Path(REC_STORE_PATH)) if REC_STORE_PATH else None
@@ -0,0 +1,123 @@
+"""In process latency metrics.
+
+Every request is timed into a histogram for its route, and the index and store
+lookups behind it are timed into histograms of their own, so a slow route can be
+broken down. Counters track things like search cache hits. Each process keeps its
+own metrics, served as JSON at /metrics.
+"""
+
+import bisect
+import contextlib
+import math
+import time
+import typing
+
+from flask import Flask, g, request
+
+# upper bounds of the histogram buckets, in milliseconds
+BUCKETS_MS = tuple(m * 10**e for e in range(-1, 4) for m in (1, 2.5, 5)) + (math.inf,)
+
+
+class Histogram:
+    """Count observations into fixed latency buckets."""
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS_MS)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def observe(self, ms: float) -> None:
+        """Record an observation."""
+        self.counts[bisect.bisect_left(BUCKETS_MS, ms)] += 1
+        self.count += 1
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+
+    def quantile(self, q: float) -> float:
+        """Estimate a quantile, as the upper bound of the bucket it falls in."""
+        rank, seen = q * self.count, 0
+        for bound, count in zip(BUCKETS_MS, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max_ms)
+        return self.max_ms
+
+    def snapshot(self) -> dict:
+        """Summarize the histogram."""
+        return dict(
+            count=self.count,
+            mean_ms=self.total_ms / self.count if self.count else 0.0,
+            max_ms=self.max_ms,
+            p50_ms=self.quantile(0.5),
+            p90_ms=self.quantile(0.9),
+            p99_ms=self.quantile(0.99),
+            buckets={
+                f"{bound:g}": count
+                for bound, count in zip(BUCKETS_MS, self.counts)
+                if count
+            },
+        )
+
+
+class Metrics:
+    """Named latency histograms and counters."""
+
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+
+    def observe(self, name: str, seconds: float) -> None:
+        """Record a duration."""
+        if name not in self.histograms:
+            self.histograms[name] = Histogram()
+        self.histograms[name].observe(seconds * 1000)
+
+    @contextlib.contextmanager
+    def timer(self, name: str) -> typing.Iterator[None]:
+        """Time a block of code."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def count(self, name: str, n: int = 1) -> None:
+        """Increment a counter."""
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def snapshot(self) -> dict:
+        """Summarize everything."""
+        return dict(
+            histograms={k: v.snapshot() for k, v in sorted(self.histograms.items())},
+            counters=dict(sorted(self.counters.items())),
+        )
+
+    def reset(self) -> None:
+        """Drop everything."""
+        self.histograms.clear()
+        self.counters.clear()
+
+
+METRICS = Metrics()
+
+
+def start_timer():
+    """Note when a request started."""
+    g.request_start = time.perf_counter()
+
+
+def record_request(response):
+    """Time a request into the histogram of its route."""
+    start = g.pop("request_start", None)
+    if start is not None:
+        rule = request.url_rule.rule if request.url_rule else "unmatched"
+        METRICS.observe(f"route {rule}", time.perf_counter() - start)
+        METRICS.count(f"status {response.status_code}")
+    return response
+
+
+def init_app(app: Flask) -> None:
+    """Time every request of an app."""
+    app.before_request(start_timer)
+    app.after_request(record_request)
@@ -2,36 +2,89 @@
 
 import typing
 
-from flask import Blueprint, current_app, jsonify, render_template, request
+from flask import Blueprint, current_app, g, jsonify, render_template, request
+
+from . import limiter
+from .metrics import METRICS
 
 bp = Blueprint("routes", __name__)
 
+# limits on basket requests
+MAX_BASKET_SIZE = 1000
+MAX_BASKET_K = 100
+MAX_GROUP_ID = 2**63 - 1
+
+# limits on suggest requests, which are made as the user types
+MAX_SUGGEST_K = 20
+SUGGEST_RATE_LIMIT = "20 per second"
+
+
+def release():
+    """Get the search index release serving this request, None without an index.
+
+    It is got once per request, so that a swap midway through cannot mix the
+    search results of one build with the store of another.
+    """
+    if "release" not in g:
+        index = current_app.config.get("SEARCH_INDEX")
+        g.release = index.current() if index is not None else None
+    return g.release
+
+
+def rec_store():
+    """Get the recommendation store, None if there is not one."""
+    store = current_app.config.get("REC_STORE")
+    if store is None and release() is not None:
+        store = release().sidecars["store"].value
+    return store
+
+
+def suggest_index():
+    """Get the suggest index, None if there is not one."""
+    suggest = current_app.config.get("SUGGEST_INDEX")
+    if suggest is None and release() is not None:
+        suggest = release().sidecars["suggest"].value
+    return suggest
+
 
 def search(query: str) -> typing.Iterable[int]:
-    """Run the search query and process results accordingly."""
-    with current_app.config["SEARCH_INDEX"].searcher() as searcher:
-        return [
-            i["group_id"]
-            for i in searcher.search(
-                current_app.config["QUERY_PARSER"].parse(query), limit=20
-            )
-            if i.get("recommendations_str")
-        ]
+    """Run the search query and process results accordingly.
+
+    Only groups with recommendations are returned. Those are looked up in the store
+    if there is one, which lets the app run on a lean index (see make_search_index).
+    """
+    group_ids = current_app.config["SEARCH_INDEX"].search(
+        query, limit=20, release=release()
+    )
+    store = rec_store()
+    if store is None:
+        return list(group_ids)
+    with METRICS.timer("store recommendations"):
+        return [i for i in group_ids if store.recommendations(i)]
 
 
 def enrich_groups(*group_ids: int) -> typing.Iterable[dict]:
     """Enrich group IDs with metadata."""
+    store = rec_store()
+    if store is not None:
+        with METRICS.timer("store group"):
+            result = [i for i in map(store.group, group_ids) if i is not None]
+        if len(result) == 1:
+            return result[0]
+        return result
+
     result = []
-    with current_app.config["SEARCH_INDEX"].searcher() as searcher:
-        for g in group_ids:
-            group_result = searcher.document(group_id=g)
+    for group_id in group_ids:
+        group_result = current_app.config["SEARCH_INDEX"].document(
+            group_id, release=release()
+        )
 
-            # convert rec groups string to list
-            group_result["recommendations"] = [
-                int(i) for i in group_result["recommendations_str"].split(",")
-            ]
-            del [group_result["recommendations_str"]]
-            result.append(group_result)
+        # convert rec groups string to list
+        group_result["recommendations"] = [
+            int(i) for i in group_result["recommendations_str"].split(",")
+        ]
+        del [group_result["recommendations_str"]]
+        result.append(group_result)
 
     if len(result) == 1:
         return result[0]
@@ -40,8 +93,12 @@ def enrich_groups(*group_ids: int) -> typing.Iterable[dict]:
 
 def recommendations(group_id: int) -> typing.Iterable[int]:
     """Get recommendations for a group ID."""
-    with current_app.config["SEARCH_INDEX"].searcher() as searcher:
-        doc = searcher.document(group_id=group_id)
+    store = rec_store()
+    if store is not None:
+        with METRICS.timer("store recommendations"):
+            return store.recommendations(group_id)
+
+    doc = current_app.config["SEARCH_INDEX"].document(group_id, release=release())
 
     if doc is None or not doc.get("recommendations_str"):
         return []
@@ -49,6 +106,18 @@ def recommendations(group_id: int) -> typing.Iterable[int]:
     return [int(i) for i in doc["recommendations_str"].split(",")]
 
 
+def id_list(value: typing.Union[str, list]) -> typing.List[int]:
+    """Convert a comma separated string or a JSON list into group IDs."""
+    if isinstance(value, str):
+        value = [i for i in value.split(",") if i.strip()]
+    if not isinstance(value, list) or any(isinstance(i, bool) for i in value):
+        raise ValueError("Not a list of IDs.")
+    ids = [int(i) for i in value]
+    if any(abs(i) > MAX_GROUP_ID for i in ids):
+        raise ValueError("IDs out of range.")
+    return ids
+
+
 @bp.route("/")
 def search_form():
     """Present a search form and handle results."""
@@ -102,3 +171,84 @@ def recs_api():
             consequents=enrich_groups(*recs),
         )
     )
+
+
+@bp.route("/api/recs/basket", methods=["GET", "POST"])
+def basket_api():
+    """Provide an API for recommendations given a basket of groups.
+
+    POST a JSON object, or pass url params, with group_ids: a list (comma delimited
+    in the url) of seed group IDs. Optionally pass exclude: group IDs never to
+    recommend, and k: the number of recommendations. Get the enriched top k
+    recommendations across all seeds, each with its score.
+    """
+    store = rec_store()
+    if store is None:
+        return (
+            jsonify(dict(success=False, message="Basket recommendations unavailable.")),
+            503,
+        )
+
+    body = request.get_json(silent=True)
+    params = body if isinstance(body, dict) and body else request.args
+    try:
+        group_ids = id_list(params.get("group_ids", []))
+        exclude = id_list(params.get("exclude", []))
+        k = int(params.get("k", 10))
+    except (TypeError, ValueError, OverflowError):
+        group_ids, k = [], 0
+
+    if not 0 < len(group_ids) <= MAX_BASKET_SIZE or not 0 < k <= MAX_BASKET_K:
+        message = (
+            f"Provide 1-{MAX_BASKET_SIZE} group_ids, "
+            f"and a k between 1 and {MAX_BASKET_K}."
+        )
+        return jsonify(dict(success=False, message=message)), 400
+
+    with METRICS.timer("store basket"):
+        recs = store.basket(group_ids, exclude=exclude, k=k)
+    if not recs:
+        return jsonify(dict(success=False, message="No recommendations found."))
+
+    return jsonify(
+        dict(
+            success=True,
+            consequents=[dict(store.group(g), score=score) for g, score in recs],
+        )
+    )
+
+
+@bp.route("/api/suggest")
+@limiter.limit(SUGGEST_RATE_LIMIT)
+def suggest_api():
+    """Provide typeahead suggestions.
+
+    Pass in url params: q=<text>, and optionally k=<integer>. Get the k most snatched
+    groups whose album or artist name has a word starting with the text.
+    """
+    suggest = suggest_index()
+    if suggest is None:
+        return (
+            jsonify(dict(success=False, message="Suggestions unavailable.")),
+            503,
+        )
+
+    query = request.args.get("q")
+    k = request.args.get("k", "10")
+    if query is None or not k.isdigit() or not 0 < int(k) <= MAX_SUGGEST_K:
+        message = f"Provide q, and a k between 1 and {MAX_SUGGEST_K}."
+        return jsonify(dict(success=False, message=message)), 400
+
+    with METRICS.timer("suggest"):
+        suggestions = suggest.suggest(query, int(k))
+    return jsonify(dict(success=True, suggestions=suggestions))
+
+
+@bp.route("/metrics")
+def metrics():
+    """Provide latency metrics of this process.
+
+    Get a histogram of the latency of each route, and of the index and store lookups
+    behind them, plus counters of response statuses and search cache hits.
+    """
+    return jsonify(METRICS.snapshot())
@@ -0,0 +1,281 @@
+"""A shared, hot swappable search index.
+
+The app keeps one searcher open for the life of the process rather than opening one
+per request. The index is opened on first use (or by warm()), not at import, and is
+checked for changes at most every check_interval seconds. A new build is picked up
+without a restart if it is:
+
+- updated in place, as by make_search_index --update or build.update.
+- swapped in behind a symlink: build into a new directory, then atomically replace
+  the symlink, e.g. `ln -s builds/new tmp && mv -T tmp whoosh_index`.
+- moved into a versioned directory: if the index path is not itself an index, the
+  last of its subdirectories (by name) holding an index is used. Build elsewhere and
+  `mv` it in, so a half written build is never seen.
+
+The recommendation store and the suggest index in the index directory, if there are
+any, are swapped along with the index. Search results are cached by query, and the
+cache is cleared whenever the index changes.
+"""
+
+import collections
+import os
+import threading
+import time
+import typing
+from pathlib import Path
+
+from whoosh.index import exists_in, open_dir
+from whoosh.qparser import MultifieldParser, OrGroup
+
+from .metrics import METRICS
+from .store import RecommendationStore
+from .suggest import SuggestIndex
+
+STORE_FILENAME = "recommendations.bin"
+SUGGEST_FILENAME = "suggest.bin"
+
+# files shipped in the index directory: name -> (filename, how to open it)
+SIDECARS = dict(
+    store=(STORE_FILENAME, RecommendationStore.open),
+    suggest=(SUGGEST_FILENAME, SuggestIndex.open),
+)
+
+
+class QueryCache:
+    """A bounded LRU cache whose entries expire after ttl seconds."""
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 300.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.items = collections.OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def get(self, key: str) -> typing.Optional[tuple]:
+        """Get a cached value, None if it is missing or expired."""
+        item = self.items.get(key)
+        if item is None:
+            return None
+        expires, value = item
+        if expires < time.monotonic():
+            del self.items[key]
+            return None
+        self.items.move_to_end(key)
+        return value
+
+    def put(self, key: str, value: tuple) -> None:
+        """Cache a value, evicting the least recently used if full."""
+        if self.maxsize < 1:
+            return
+        self.items[key] = (time.monotonic() + self.ttl, value)
+        self.items.move_to_end(key)
+        while len(self.items) > self.maxsize:
+            self.items.popitem(last=False)
+
+    def clear(self) -> None:
+        """Drop everything."""
+        self.items.clear()
+
+
+def normalize_query(query: str) -> str:
+    """Normalize a query into its cache key.
+
+    Only whitespace is normalized, as the parser treats uppercase operators (AND,
+    OR, NOT) differently from their lowercase words.
+    """
+    return " ".join(query.split())
+
+
+def file_version(path: Path) -> typing.Optional[tuple]:
+    """Identify a version of a file, None if it does not exist."""
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+class Sidecar(typing.NamedTuple):
+    """An opened file shipped with the index, None if it is missing."""
+
+    version: typing.Optional[tuple]
+    value: typing.Any
+
+
+def open_sidecar(path: Path, name: str, current: Sidecar = None) -> Sidecar:
+    """Open a file shipped with the index, unless the current version is the same."""
+    filename, opener = SIDECARS[name]
+    version = file_version(path / filename)
+    if current is not None and current.version == version:
+        return current
+    return Sidecar(version, opener(path / filename) if version else None)
+
+
+class Release(typing.NamedTuple):
+    """An opened build of the index, and the files shipped with it."""
+
+    path: Path
+    searcher: typing.Any
+    parser: MultifieldParser
+    sidecars: typing.Dict[str, Sidecar]
+
+
+class SearchIndex:
+    """A long lived searcher over an index which can be swapped while serving."""
+
+    def __init__(
+        self,
+        path: Path,
+        fields: typing.Sequence[str] = ("name", "artist_name"),
+        cache_size: int = 1024,
+        cache_ttl: float = 300.0,
+        check_interval: float = 1.0,
+    ):
+        self.path = Path(path)
+        self.fields = list(fields)
+        self.cache = QueryCache(cache_size, cache_ttl)
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.release = None
+        self.retired = None
+        self.checked_at = 0.0
+        self.reloads = 0
+
+    def resolve(self) -> Path:
+        """Find the directory of the current build."""
+        path = Path(os.path.realpath(self.path))
+        if exists_in(path):
+            return path
+        versions = (
+            sorted(i for i in path.iterdir() if i.is_dir() and exists_in(i))
+            if path.is_dir()
+            else []
+        )
+        if not versions:
+            raise FileNotFoundError(f"No search index in {self.path}.")
+        return versions[-1]
+
+    def open(self, path: Path) -> Release:
+        """Open a build of the index."""
+        search_index = open_dir(path)
+        return Release(
+            path=path,
+            searcher=search_index.searcher(),
+            parser=MultifieldParser(
+                self.fields, search_index.schema, group=OrGroup.factory(0.9)
+            ),
+            sidecars={i: open_sidecar(path, i) for i in SIDECARS},
+        )
+
+    def swap(self, release: Release) -> None:
+        """Serve a new release, dropping the cache.
+
+        The release before the current one is closed now, so that requests still
+        holding the current one can finish with it. Releases share a searcher when
+        only a sidecar changed, so a searcher still in use is never closed.
+        """
+        live = (release.searcher, getattr(self.release, "searcher", None))
+        if self.retired is not None and all(
+            self.retired.searcher is not i for i in live
+        ):
+            self.retired.searcher.close()
+        self.retired, self.release = self.release, release
+        self.cache.clear()
+        self.reloads += 1
+
+    def reload(self) -> None:
+        """Check for a new build and swap it in."""
+        release = self.release
+        path = self.resolve()
+        if release is None or path != release.path:
+            with METRICS.timer("index open"):
+                self.swap(self.open(path))
+            return
+
+        # same directory, updated in place. Not searcher.refresh(), which closes the
+        # readers of the current searcher while requests may still be using it.
+        searcher = release.searcher
+        if not searcher.up_to_date():
+            searcher = open_dir(path).searcher()
+        sidecars = {i: open_sidecar(path, i, release.sidecars[i]) for i in SIDECARS}
+
+        if searcher is not release.searcher or sidecars != release.sidecars:
+            self.swap(release._replace(searcher=searcher, sidecars=sidecars))
+
+    def current(self) -> Release:
+        """Get the current release, checking for a new one if it is time to."""
+        now = time.monotonic()
+        if self.release is None or now - self.checked_at >= self.check_interval:
+            with self.lock:
+                if self.release is None or now - self.checked_at >= self.check_interval:
+                    self.reload()
+                    self.checked_at = time.monotonic()
+        return self.release
+
+    def close(self) -> None:
+        """Close the searchers of the current and the retired release."""
+        with self.lock:
+            searchers = {
+                id(i.searcher): i.searcher for i in (self.release, self.retired) if i
+            }
+            for searcher in searchers.values():
+                searcher.close()
+            self.release = self.retired = None
+
+    def warm(self) -> None:
+        """Open the index now rather than on the first request."""
+        self.current()
+
+    @property
+    def store(self) -> typing.Optional[RecommendationStore]:
+        """The recommendation store shipped with the index, if there is one."""
+        return self.current().sidecars["store"].value
+
+    @property
+    def suggest(self) -> typing.Optional[SuggestIndex]:
+        """The suggest index shipped with the index, if there is one."""
+        return self.current().sidecars["suggest"].value
+
+    def search(
+        self, query: str, limit: int = 20, release: Release = None
+    ) -> typing.Tuple[int, ...]:
+        """Search for groups with recommendations, returning their group IDs.
+
+        Searches the given release, else the current one. Results of the current
+        release are cached. A lean index does not store the recommendations, so its
+        results are not filtered (see routes.search).
+        """
+        if release is None:
+            release = self.current()
+        cached = release is self.release
+        key = f"{limit}:{normalize_query(query)}"
+        result = self.cache.get(key) if cached else None
+        if result is not None:
+            METRICS.count("search cache hit")
+            return result
+
+        # whoosh does not store empty fields, so groups without recommendations
+        # have no recommendations_str
+        lean = "recommendations_str" not in release.searcher.schema
+        METRICS.count("search cache miss")
+        with METRICS.timer("whoosh search"):
+            result = tuple(
+                i["group_id"]
+                for i in release.searcher.search(
+                    release.parser.parse(query), limit=limit
+                )
+                if lean or i.get("recommendations_str")
+            )
+        if cached:
+            self.cache.put(key, result)
+        return result
+
+    def document(self, group_id: int, release: Release = None) -> typing.Optional[dict]:
+        """Get the stored fields of a group, None if it is not in the index.
+
+        Looks in the given release, else the current one.
+        """
+        searcher = (release or self.current()).searcher
+        with METRICS.timer("whoosh document"):
+            return searcher.document(group_id=group_id)
@@ -0,0 +1,202 @@
+"""Memory mapped, array backed recommendation store.
+
+The store is a single file of named numpy arrays, written by
+build.make_rec_store. The file is laid out as:
+
+    magic | header length (uint64) | JSON header | arrays
+
+The header maps array names to their dtype, shape and byte offset. Arrays are 64-byte
+aligned so they can be used in place from a read only memory map, which lets every
+worker process share the same pages.
+
+The recommendation store holds these arrays, where n is the number of groups:
+
+    row_of          int32 [max group_id + 1]  row of each group_id, -1 if missing.
+    group_id        int32 [n]
+    name            int32 [n]  string number of the group name.
+    artist_name     int32 [n]  string number of the artist name.
+    rec_offsets     int64 [n + 1]  recommendations of row i are recs[rec_offsets[i]:
+    recs            int32 [*]      rec_offsets[i + 1]], best first.
+    candidate_offsets  int64 [n + 1]    the deeper list of candidates and their
+    candidates         int32 [*]        lift, laid out like the recommendations.
+    candidate_lift     float32 [*]
+    string_offsets  int64 [n strings + 1]  utf-8 string table.
+    strings         uint8 [*]
+"""
+
+import json
+import mmap
+import os
+import typing
+from pathlib import Path
+
+import numpy as np
+
+MAGIC = b"RECSTORE"
+ALIGN = 64
+
+
+def aligned(n: int) -> int:
+    """Round a byte count up to the array alignment."""
+    return -(-n // ALIGN) * ALIGN
+
+
+def write_arrays(path: Path, arrays: typing.Dict[str, np.ndarray]) -> None:
+    """Write named arrays into a store file.
+
+    The file is written next to its destination and moved into place, so a reader
+    never sees a partial file.
+    """
+    arrays = {k: np.ascontiguousarray(v) for k, v in arrays.items()}
+
+    # offsets are relative to the start of the first array
+    specs, size = {}, 0
+    for name, arr in arrays.items():
+        specs[name] = dict(dtype=arr.dtype.str, shape=arr.shape, offset=size)
+        size += aligned(arr.nbytes)
+    header = json.dumps(specs).encode()
+    start = aligned(len(MAGIC) + 8 + len(header))
+
+    tmp = Path(f"{path}.tmp")
+    with tmp.open("wb") as f:
+        f.write(MAGIC)
+        f.write(np.uint64(len(header)).tobytes())
+        f.write(header)
+        for name, arr in arrays.items():
+            f.seek(start + specs[name]["offset"])
+            f.write(arr.tobytes())
+        f.truncate(start + size)
+    os.replace(tmp, path)
+
+
+def read_arrays(path: Path) -> typing.Dict[str, np.ndarray]:
+    """Memory map a store file, returning its arrays as read only views."""
+    with open(path, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    if mm[: len(MAGIC)] != MAGIC:
+        raise ValueError(f"{path} is not a store file.")
+    size = int(np.frombuffer(mm, dtype=np.uint64, count=1, offset=len(MAGIC))[0])
+    specs = json.loads(mm[len(MAGIC) + 8 : len(MAGIC) + 8 + size])
+    start = aligned(len(MAGIC) + 8 + size)
+
+    arrays = {}
+    for name, spec in specs.items():
+        arrays[name] = np.frombuffer(
+            mm,
+            dtype=np.dtype(spec["dtype"]),
+            count=int(np.prod(spec["shape"])),
+            offset=start + spec["offset"],
+        ).reshape(spec["shape"])
+    return arrays
+
+
+def read_string(offsets: np.ndarray, strings: np.ndarray, n: int) -> str:
+    """Get a string from a string table of offsets and a utf-8 blob."""
+    start, end = offsets[n : n + 2]
+    return strings[start:end].tobytes().decode()
+
+
+class RecommendationStore:
+    """Look up recommendations and group metadata by group_id in O(1)."""
+
+    def __init__(self, arrays: typing.Dict[str, np.ndarray]):
+        self.arrays = arrays
+        self.row_of = arrays["row_of"]
+        self.group_ids = arrays["group_id"]
+        self.names = arrays["name"]
+        self.artist_names = arrays["artist_name"]
+        self.rec_offsets = arrays["rec_offsets"]
+        self.recs = arrays["recs"]
+        self.candidate_offsets = arrays["candidate_offsets"]
+        self.candidates = arrays["candidates"]
+        self.candidate_lift = arrays["candidate_lift"]
+        self.string_offsets = arrays["string_offsets"]
+        self.strings = arrays["strings"]
+
+    @classmethod
+    def open(cls, path: Path) -> "RecommendationStore":
+        """Memory map a store file."""
+        return cls(read_arrays(path))
+
+    def __len__(self) -> int:
+        return len(self.group_ids)
+
+    def row(self, group_id: int) -> int:
+        """Get the row of a group, -1 if it is not in the store."""
+        if group_id < 0 or group_id >= len(self.row_of):
+            return -1
+        return int(self.row_of[group_id])
+
+    def string(self, n: int) -> str:
+        """Get a string from the string table."""
+        return read_string(self.string_offsets, self.strings, n)
+
+    def recommendations(self, group_id: int) -> typing.List[int]:
+        """Get the recommendations for a group, best first."""
+        row = self.row(group_id)
+        if row < 0:
+            return []
+        start, end = self.rec_offsets[row : row + 2]
+        return self.recs[start:end].tolist()
+
+    def group(self, group_id: int) -> typing.Optional[dict]:
+        """Get a group's metadata and recommendations, None if it is not stored."""
+        row = self.row(group_id)
+        if row < 0:
+            return None
+        start, end = self.rec_offsets[row : row + 2]
+        return dict(
+            group_id=int(self.group_ids[row]),
+            name=self.string(self.names[row]),
+            artist_name=self.string(self.artist_names[row]),
+            recommendations=self.recs[start:end].tolist(),
+        )
+
+    def basket(
+        self,
+        group_ids: typing.Iterable[int],
+        exclude: typing.Iterable[int] = (),
+        k: int = 10,
+    ) -> typing.List[typing.Tuple[int, float]]:
+        """Recommend groups for a basket of seed groups.
+
+        A candidate scores the sum of its lift across the seeds which it is a
+        candidate for. The seeds and excluded groups are never recommended. Returns
+        the top k (group_id, score) pairs, best first.
+        """
+        if k < 1:
+            return []
+
+        seeds = np.unique(np.asarray(list(group_ids), dtype=np.int64))
+        seeds = seeds[(seeds >= 0) & (seeds < len(self.row_of))]
+        rows = self.row_of[seeds]
+        rows = rows[rows >= 0]
+
+        # gather the candidate lists of all seeds in one go
+        starts = self.candidate_offsets[rows]
+        lengths = self.candidate_offsets[rows + 1] - starts
+        ends = np.cumsum(lengths)
+        index = np.arange(ends[-1] if len(ends) else 0) + np.repeat(
+            starts - (ends - lengths), lengths
+        )
+
+        group_ids, inverse = np.unique(self.candidates[index], return_inverse=True)
+        scores = np.bincount(
+            inverse.ravel(),
+            weights=self.candidate_lift[index],
+            minlength=len(group_ids),
+        )
+
+        excluded = np.concatenate([seeds, np.asarray(list(exclude), dtype=np.int64)])
+        keep = ~np.isin(group_ids, excluded)
+        group_ids, scores = group_ids[keep], scores[keep]
+
+        # best k, ties broken by group_id
+        if len(scores) > k:
+            top = np.argpartition(-scores, k - 1)[:k]
+            cutoff = scores[top].min()
+            top = np.flatnonzero(scores >= cutoff)
+            group_ids, scores = group_ids[top], scores[top]
+        order = np.lexsort((group_ids, -scores))[:k]
+        return list(zip(group_ids[order].tolist(), scores[order].tolist()))
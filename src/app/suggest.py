@@ -0,0 +1,160 @@
+"""Memory mapped prefix index for typeahead suggestions.
+
+The index is a store file (see app.store) written by build.make_suggest_index. Each
+group is keyed by its normalized album and artist names, starting from every word,
+so "dark side" finds "The Dark Side of the Moon". The keys are sorted, so the keys
+matching a prefix are a contiguous range found by bisection, and the best groups in
+that range are picked by snatch count. The best groups of every short prefix, which
+match too many keys to rank per request, are precomputed.
+
+The arrays are, where n is the number of groups and m the number of keys:
+
+    group_id        int32 [n]
+    name            int32 [n]  string number of the group name.
+    artist_name     int32 [n]  string number of the artist name.
+    key_offsets     int64 [m + 1]  utf-8 keys, sorted.
+    keys            uint8 [*]
+    key_row         int32 [m]  row of the group of each key.
+    key_score       int64 [m]  snatch count of the group of each key.
+    top_offsets     int64 [p + 1]  the p short prefixes, sorted.
+    top_prefixes    uint8 [*]
+    top_rows        int32 [p, k]  rows of the best k groups of each short prefix,
+                                  best first, padded with -1.
+    string_offsets  int64 [n strings + 1]  utf-8 string table.
+    strings         uint8 [*]
+"""
+
+import bisect
+import re
+import typing
+import unicodedata
+from pathlib import Path
+
+import numpy as np
+
+from .store import read_arrays, read_string
+
+# prefixes up to this long have their suggestions precomputed
+SHORT_PREFIX_LENGTH = 2
+N_SUGGESTIONS = 10
+
+
+def normalize(text: str) -> str:
+    """Normalize text for prefix matching.
+
+    Accents are stripped, case folded, and anything but letters and digits becomes a
+    single space.
+    """
+    text = unicodedata.normalize("NFKD", text)
+    text = "".join(i for i in text if not unicodedata.combining(i)).casefold()
+    return " ".join(re.split(r"[\W_]+", text)).strip()
+
+
+def word_keys(text: str) -> typing.List[str]:
+    """Key a normalized name from the start of every word."""
+    words = text.split()
+    return [" ".join(words[i:]) for i in range(len(words))]
+
+
+class SortedKeys(typing.Sequence[bytes]):
+    """View a utf-8 blob and its offsets as a sorted sequence of bytes."""
+
+    def __init__(self, offsets: np.ndarray, data: np.ndarray):
+        self.offsets = offsets
+        self.data = data
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> bytes:
+        start, end = self.offsets[i : i + 2]
+        return self.data[start:end].tobytes()
+
+    def prefix_range(self, prefix: bytes) -> typing.Tuple[int, int]:
+        """Get the range of keys starting with a prefix."""
+        lo = bisect.bisect_left(self, prefix)
+        # every key with the prefix sorts before the prefix followed by 0xff, as
+        # 0xff never occurs in utf-8.
+        hi = bisect.bisect_left(self, prefix + b"\xff", lo)
+        return lo, hi
+
+
+def distinct_rows(rows: np.ndarray, scores: np.ndarray, k: int) -> np.ndarray:
+    """Get the distinct rows with the best k scores, best first.
+
+    Ties are broken by row, which is in group_id order.
+    """
+    rows = rows[np.lexsort((rows, -scores))]
+    _, first = np.unique(rows, return_index=True)
+    return rows[np.sort(first)][:k]
+
+
+def best_rows(rows: np.ndarray, scores: np.ndarray, k: int) -> np.ndarray:
+    """Like distinct_rows, ranking only the best keys when there are many."""
+    n = 4 * k
+    if len(rows) > n:
+        # a group has a few keys at most, so its best key is likely among these.
+        # All keys of a group have the same score, so any group left out of them
+        # ranks below those in them.
+        top = np.argpartition(-scores, n - 1)[:n]
+        keep = scores >= scores[top].min()
+        result = distinct_rows(rows[keep], scores[keep], k)
+        if len(result) == k:
+            return result
+    return distinct_rows(rows, scores, k)
+
+
+class SuggestIndex:
+    """Suggest groups whose album or artist name has a given prefix."""
+
+    def __init__(self, arrays: typing.Dict[str, np.ndarray]):
+        self.arrays = arrays
+        self.group_ids = arrays["group_id"]
+        self.names = arrays["name"]
+        self.artist_names = arrays["artist_name"]
+        self.keys = SortedKeys(arrays["key_offsets"], arrays["keys"])
+        self.key_row = arrays["key_row"]
+        self.key_score = arrays["key_score"]
+        self.top_prefixes = SortedKeys(arrays["top_offsets"], arrays["top_prefixes"])
+        self.top_rows = arrays["top_rows"]
+        self.string_offsets = arrays["string_offsets"]
+        self.strings = arrays["strings"]
+
+    @classmethod
+    def open(cls, path: Path) -> "SuggestIndex":
+        """Memory map a suggest index file."""
+        return cls(read_arrays(path))
+
+    def __len__(self) -> int:
+        return len(self.group_ids)
+
+    def string(self, n: int) -> str:
+        """Get a string from the string table."""
+        return read_string(self.string_offsets, self.strings, n)
+
+    def rows(self, prefix: str, k: int = N_SUGGESTIONS) -> np.ndarray:
+        """Get the rows of the best k groups matching a normalized prefix."""
+        encoded = prefix.encode()
+        if len(prefix) <= SHORT_PREFIX_LENGTH and k <= self.top_rows.shape[1]:
+            i = bisect.bisect_left(self.top_prefixes, encoded)
+            if i < len(self.top_prefixes) and self.top_prefixes[i] == encoded:
+                rows = self.top_rows[i, :k]
+                return rows[rows >= 0]
+            return self.top_rows[:0, 0]
+
+        lo, hi = self.keys.prefix_range(encoded)
+        return best_rows(self.key_row[lo:hi], self.key_score[lo:hi], k)
+
+    def suggest(self, query: str, k: int = N_SUGGESTIONS) -> typing.List[dict]:
+        """Suggest the most snatched groups matching a query, best first."""
+        prefix = normalize(query)
+        if not prefix or k < 1:
+            return []
+        return [
+            dict(
+                group_id=int(self.group_ids[row]),
+                name=self.string(self.names[row]),
+                artist_name=self.string(self.artist_names[row]),
+            )
+            for row in self.rows(prefix, k).tolist()
+        ]
@@ -1,5 +1,6 @@
 import os
 
+import gevent
 from gevent.pywsgi import WSGIServer
 
 from . import create_app
@@ -10,4 +11,7 @@ port = int(os.getenv("PORT", "8000"))
 http_server = WSGIServer(("0.0.0.0", port), app)
 
 if __name__ == "__main__":
+    # open the index once the server is listening, rather than on the first request
+    http_server.start()
+    gevent.spawn(app.config["SEARCH_INDEX"].warm)
     http_server.serve_forever()
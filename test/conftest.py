@@ -0,0 +1,59 @@
+"""Fixtures shared by the build tests.
+
+The build tests run against a small synthetic scrape from build.synthetic_snatches,
+in the same one JSON payload per line format as build.user_snatches.
+"""
+
+import contextlib
+import sqlite3
+
+import pytest
+from whoosh.index import open_dir
+
+from build import make_recommendations as mr
+from build import make_sqlite, synthetic_snatches
+
+
+def synthetic_lines(n_users=300, **kwargs):
+    """Lines of a small synthetic scrape, of users from the start of it by default."""
+    kwargs = dict(dict(n_groups=60, n_artists=12, mean_snatches=13), **kwargs)
+    return list(synthetic_snatches.generate_lines(n_users=n_users, **kwargs))
+
+
+def build_db(db_path, lines):
+    """Build a database from lines using the per-line make_sqlite path."""
+    make_sqlite.make_fresh_db(db_path)
+    for line in lines:
+        make_sqlite.process_line(db_path, line)
+    return db_path
+
+
+def dump_table(db_path, sql):
+    """Fetch all rows of a query."""
+    with contextlib.closing(sqlite3.connect(db_path)) as conn:
+        return conn.execute(sql).fetchall()
+
+
+def index_docs(index_path):
+    """Get all the stored documents of an index."""
+    with open_dir(index_path).searcher() as searcher:
+        return sorted(searcher.all_stored_fields(), key=lambda i: i["group_id"])
+
+
+@pytest.fixture
+def snatch_lines():
+    """Lines of a synthetic scrape."""
+    return synthetic_lines()
+
+
+@pytest.fixture
+def snatch_db(tmp_path, snatch_lines):
+    """A database built from the synthetic scrape."""
+    return build_db(tmp_path / "data.db", snatch_lines)
+
+
+@pytest.fixture
+def recs_db(snatch_db):
+    """The synthetic database with recommendations."""
+    mr.run(snatch_db, engine="sparse", batch=20)
+    return snatch_db
@@ -122,3 +122,34 @@ def test_recs_api_no_results(client, monkeypatch):
     result = json.loads(rv.data.decode())
 
     assert not result["success"]
+
+
+def test_basket_api_no_store(client):
+    """Test the basket api needs the recommendation store."""
+    rv = client.post("/api/recs/basket", json=dict(group_ids=[1]))
+    assert rv.status_code == 503
+
+
+@pytest.mark.parametrize(
+    "request_args",
+    [
+        dict(json=dict()),
+        dict(json=dict(group_ids=[])),
+        dict(json=dict(group_ids="1,a")),
+        dict(json=dict(group_ids=[1, True])),
+        dict(json=dict(group_ids=[1], k=0)),
+        dict(json=dict(group_ids=list(range(routes.MAX_BASKET_SIZE + 1)))),
+        dict(json=[1, 2]),
+        dict(json=dict(group_ids=[2**64])),
+        dict(json=dict(group_ids=[1], exclude=[-(2**64)])),
+        dict(data='{"group_ids": [Infinity]}', content_type="application/json"),
+        dict(method="GET", query_string="group_ids=99999999999999999999999"),
+        dict(method="GET", query_string="group_ids=1&exclude=99999999999999999999999"),
+    ],
+)
+def test_basket_api_invalid(client, request_args):
+    """Test invalid basket requests."""
+    client.application.config["REC_STORE"] = "STORE"
+    rv = client.open("/api/recs/basket", **{"method": "POST", **request_args})
+    assert rv.status_code == 400
+    assert not json.loads(rv.data.decode())["success"]
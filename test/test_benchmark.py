@@ -0,0 +1,61 @@
+"""Test the benchmarks on the synthetic database."""
+
+from app.search import STORE_FILENAME
+from build import benchmark, make_rec_store
+from build import make_recommendations as mr
+from build import make_search_index
+
+from .conftest import dump_table
+
+
+def test_build_benchmarks(snatch_db):
+    """Test each configuration of the build stages is timed."""
+    recs = benchmark.bench_make_recommendations(
+        snatch_db, engines=["sql", "sparse"], batches=[7, 100]
+    )
+    mr.run(snatch_db, engine="sparse", batch=20)
+    index = benchmark.bench_make_search_index(snatch_db, procs=[1, 2], lean=True)
+
+    assert [(i["engine"], i["batch"]) for i in recs["runs"]] == [
+        ("sql", 7),
+        ("sql", 100),
+        ("sparse", 7),
+        ("sparse", 100),
+    ]
+    assert len({i["rows"] for i in recs["runs"]}) == 1
+    assert [(i["procs"], i["lean"]) for i in index["runs"]] == [
+        (1, False),
+        (2, False),
+        (1, True),
+        (2, True),
+    ]
+    assert all(i["docs"] == recs["groups"] for i in index["runs"])
+
+
+def test_app_benchmark(recs_db, tmp_path):
+    """Test the routes are loaded on a served index, with server side metrics."""
+    index_path = tmp_path / "index"
+    make_search_index.make_index(recs_db, index_path)
+    make_rec_store.make_store(recs_db, index_path / STORE_FILENAME)
+
+    result = benchmark.bench_app(index_path, concurrency=4, n_requests=20)
+
+    assert list(result["routes"]) == list(benchmark.APP_ROUTES)
+    for route in result["routes"].values():
+        assert route["requests"] == 20
+        assert route["errors"] == 0
+    histograms = result["server_metrics"]["histograms"]
+    assert histograms["route /recs/<int:group_id>"]["count"] == 30
+    assert "whoosh search" in histograms
+    assert "search cache hit" not in result["server_metrics"]["counters"]
+
+
+def test_app_paths_without_store(recs_db, tmp_path):
+    """Test paths are sampled from a full index, skipping groups without recs."""
+    make_search_index.make_index(recs_db, tmp_path / "index")
+
+    paths = benchmark.app_paths(tmp_path / "index", n=50)
+
+    recs = dump_table(recs_db, "select distinct group_id from recommendations")
+    sampled = {int(path.split("/")[-1]) for path, _ in paths["/recs/<id>"]}
+    assert sampled <= {i for (i,) in recs}
@@ -0,0 +1,121 @@
+"""Test building and updating the search index."""
+
+import contextlib
+import sqlite3
+
+import pytest
+from whoosh.index import open_dir
+from whoosh.qparser import QueryParser
+
+import app
+import app.routes as routes
+from app.search import STORE_FILENAME, SearchIndex
+from app.store import RecommendationStore
+from build import make_rec_store
+from build import make_search_index
+
+from .conftest import dump_table, index_docs
+
+
+@pytest.mark.parametrize("lean", [False, True])
+def test_procs_match_single_process(recs_db, tmp_path, lean):
+    """Test indexing with several processes gives the same documents."""
+    n = make_search_index.make_index(recs_db, tmp_path / "one", lean=lean)
+    make_search_index.make_index(
+        recs_db, tmp_path / "two", procs=2, chunksize=7, lean=lean
+    )
+
+    docs = index_docs(tmp_path / "one")
+    assert len(docs) == n
+    assert docs == index_docs(tmp_path / "two")
+    if lean:
+        assert set(docs[0]) == {"group_id", "digest"}
+
+
+def test_lean_index_search(recs_db, tmp_path):
+    """Test the lean index can still be searched by name."""
+    make_search_index.make_index(recs_db, tmp_path / "index", lean=True)
+    ((group_id, name),) = dump_table(
+        recs_db, "select group_id, name from groups limit 1"
+    )
+
+    search_index = open_dir(tmp_path / "index")
+    query = QueryParser("name", search_index.schema).parse(name)
+    with search_index.searcher() as searcher:
+        assert group_id in [i["group_id"] for i in searcher.search(query, limit=None)]
+
+
+def test_index_size_skips_sidecars(recs_db, tmp_path):
+    """Test the index size counts the Whoosh files only, not the store next to them."""
+    index_path = tmp_path / "index"
+    make_search_index.make_index(recs_db, index_path)
+    size = make_search_index.index_size(index_path)
+    make_rec_store.make_store(recs_db, index_path / STORE_FILENAME)
+
+    assert size > 0
+    assert make_search_index.index_size(index_path) == size
+
+
+@pytest.mark.parametrize("lean", [False, True])
+def test_update_only_changed(recs_db, tmp_path, lean):
+    """Test an in place update matches a fresh index, rewriting only changes."""
+    index_path = tmp_path / "index"
+    make_search_index.make_index(recs_db, index_path, lean=lean)
+
+    with contextlib.closing(sqlite3.connect(recs_db)) as conn:
+        assert make_search_index.update_index(open_dir(index_path), conn) == 0
+
+        (removed,) = conn.execute("select max(group_id) from groups").fetchone()
+        conn.execute("delete from recommendations where group_id = ?", (removed,))
+        conn.execute(
+            "delete from recommendations where recommendation_group_id = ?", (removed,)
+        )
+        conn.execute("delete from snatches where group_id = ?", (removed,))
+        conn.execute("delete from groups where group_id = ?", (removed,))
+        conn.execute("update groups set name = 'Renamed' where group_id = 1")
+        conn.commit()
+
+        n = make_search_index.update_index(open_dir(index_path), conn)
+
+    make_search_index.make_index(recs_db, tmp_path / "fresh", lean=lean)
+    docs = index_docs(index_path)
+    assert docs == index_docs(tmp_path / "fresh")
+    assert removed not in [i["group_id"] for i in docs]
+    assert 1 <= n < len(docs) / 2
+
+
+@pytest.mark.parametrize("lean", [False, True])
+def test_update_new_recommendations(recs_db, tmp_path, lean):
+    """Test new recommendations only rewrite documents which store them."""
+    index_path = tmp_path / "index"
+    make_search_index.make_index(recs_db, index_path, lean=lean)
+
+    with contextlib.closing(sqlite3.connect(recs_db)) as conn:
+        (group_id,) = conn.execute(
+            "select min(group_id) from recommendations"
+        ).fetchone()
+        conn.execute("delete from recommendations where group_id = ?", (group_id,))
+        conn.commit()
+        n = make_search_index.update_index(open_dir(index_path), conn, [group_id])
+
+    assert n == (0 if lean else 1)
+    make_search_index.make_index(recs_db, tmp_path / "fresh", lean=lean)
+    assert index_docs(index_path) == index_docs(tmp_path / "fresh")
+
+
+def test_app_searches_lean_index(recs_db, tmp_path):
+    """Test the app searches a lean index, filtering on the store."""
+    make_search_index.make_index(recs_db, tmp_path / "index", lean=True)
+    make_rec_store.make_store(recs_db, tmp_path / "recommendations.bin")
+
+    application = app.create_app(config_file=None)
+    store = RecommendationStore.open(tmp_path / "recommendations.bin")
+    application.config.update(
+        SEARCH_INDEX=SearchIndex(tmp_path / "index"), REC_STORE=store
+    )
+    group_id = next(g for g in store.group_ids.tolist() if store.recommendations(g))
+
+    with application.test_request_context():
+        result = routes.search(store.group(group_id)["name"])
+    assert group_id in result
+    assert all(store.recommendations(i) for i in result)
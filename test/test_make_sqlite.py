@@ -0,0 +1,44 @@
+"""Test building the database from the scraped JSON."""
+
+import pytest
+
+from build import make_sqlite
+from build.benchmark import dump_db
+
+from .conftest import build_db
+
+
+def test_parse_line(snatch_lines):
+    """Test the skipped lines and the unescaped names."""
+    assert make_sqlite.parse_line("\n") is None
+    parsed = [make_sqlite.parse_line(i) for i in snatch_lines]
+    assert any(i is None for i in parsed)
+
+    artists, (user_id, n), groups, snatches = next(i for i in parsed if i)
+    assert n == len(groups) == len(snatches)
+    assert all(user == user_id for user, _ in snatches)
+
+    # compilations are skipped, and names are unescaped
+    names = {name for i in parsed if i for _, _, name in i[2]}
+    names |= {name for i in parsed if i for _, name in i[0]}
+    assert "Various Artists" not in names
+    assert any("&" in i for i in names) and any('"' in i for i in names)
+    assert not any("&amp;" in i or "&quot;" in i for i in names)
+
+
+@pytest.mark.parametrize("workers, batch", [(1, 1000), (2, 7)])
+def test_bulk_load_matches_per_line(tmp_path, snatch_lines, workers, batch):
+    """Test the bulk load builds the same database as the line by line path."""
+    # users scraped twice still count twice for their groups
+    lines = snatch_lines + snatch_lines[10:20] + [""]
+    json_path = tmp_path / "data.json"
+    json_path.write_text("\n".join(lines) + "\n")
+
+    expected = dump_db(build_db(tmp_path / "per_line.db", lines))
+
+    db_path = tmp_path / "bulk.db"
+    make_sqlite.make_fresh_db(db_path)
+    make_sqlite.bulk_load(db_path, json_path, workers=workers, batch=batch)
+
+    assert any('INSERT INTO "snatches"' in i for i in expected)
+    assert dump_db(db_path) == expected
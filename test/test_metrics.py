@@ -0,0 +1,62 @@
+"""Test request and lookup metrics."""
+
+import json
+
+import pytest
+
+import app
+import app.routes as routes
+from app.metrics import METRICS, Histogram, Metrics
+
+
+@pytest.fixture
+def client():
+    """Application fixture, with empty metrics."""
+    METRICS.reset()
+    application = app.create_app(config_file=None)
+    with application.test_client() as cli:
+        yield cli
+    METRICS.reset()
+
+
+def test_histogram():
+    """Test observations are bucketed and quantiles estimated from the buckets."""
+    histogram = Histogram()
+    for ms in [0.05] * 50 + [3] * 40 + [40] * 9 + [7000]:
+        histogram.observe(ms)
+
+    result = histogram.snapshot()
+    assert result["count"] == 100
+    assert result["buckets"] == {"0.1": 50, "5": 40, "50": 9, "inf": 1}
+    assert (result["p50_ms"], result["p90_ms"], result["p99_ms"]) == (0.1, 5, 50)
+    assert result["max_ms"] == 7000
+    assert result["mean_ms"] == pytest.approx((2.5 + 120 + 360 + 7000) / 100)
+
+
+def test_timer():
+    """Test timing a block of code, and counters."""
+    metrics = Metrics()
+    with metrics.timer("block"):
+        pass
+    metrics.count("thing")
+    metrics.count("thing", 2)
+
+    result = metrics.snapshot()
+    assert result["histograms"]["block"]["count"] == 1
+    assert result["counters"] == {"thing": 3}
+
+
+def test_metrics_route(client, monkeypatch):
+    """Test requests are timed by route, along with their status."""
+    monkeypatch.setattr(routes, "recommendations", lambda *x: [])
+    for group_id in (1, 2):
+        client.get(f"/recs/{group_id}")
+    client.get("/api/recs")
+    client.get("/not/a/route")
+
+    result = json.loads(client.get("/metrics").data.decode())
+    histograms = result["histograms"]
+    assert histograms["route /recs/<int:group_id>"]["count"] == 2
+    assert histograms["route /api/recs"]["count"] == 1
+    assert histograms["route unmatched"]["count"] == 1
+    assert result["counters"] == {"status 404": 3, "status 400": 1}
@@ -0,0 +1,216 @@
+"""Test the shared search index, its cache and hot swapping builds."""
+
+import contextlib
+import os
+import sqlite3
+
+import pytest
+from whoosh.index import open_dir
+
+import app
+import app.routes as routes
+import app.search as search
+from app.search import QueryCache, SearchIndex
+from build import make_rec_store
+from build import make_search_index, make_suggest_index
+
+from .conftest import dump_table
+
+
+def rename_group(db_path, group_id, name):
+    """Rename a group in the database."""
+    with contextlib.closing(sqlite3.connect(db_path)) as conn, conn:
+        conn.execute("update groups set name = ? where group_id = ?", (name, group_id))
+
+
+def build(db_path, index_path):
+    """Build an index along with its store and suggest index."""
+    make_search_index.make_index(db_path, index_path)
+    make_rec_store.make_store(db_path, index_path / search.STORE_FILENAME)
+    make_suggest_index.make_suggest_index(db_path, index_path / search.SUGGEST_FILENAME)
+    return index_path
+
+
+def test_query_cache(monkeypatch):
+    """Test the cache evicts the least recently used, and expires entries."""
+    now = [0.0]
+    monkeypatch.setattr(search.time, "monotonic", lambda: now[0])
+    cache = QueryCache(maxsize=2, ttl=10)
+
+    cache.put("a", (1,))
+    cache.put("b", (2,))
+    assert cache.get("a") == (1,)
+    cache.put("c", (3,))
+    assert cache.get("b") is None
+    assert [cache.get(i) for i in "ac"] == [(1,), (3,)]
+
+    now[0] = 11.0
+    assert cache.get("a") is None
+    assert len(cache) == 1
+
+
+def test_lazy_and_cached(recs_db, tmp_path, monkeypatch):
+    """Test the index is opened on first use and results come from the cache."""
+    index = SearchIndex(build(recs_db, tmp_path / "index"))
+    assert index.release is None
+    ((name,),) = dump_table(
+        recs_db,
+        "select name from groups where group_id in (select group_id from "
+        "recommendations) limit 1",
+    )
+
+    first = index.search(name.replace(" ", "  "))
+    searcher = index.release.searcher
+    monkeypatch.setattr(searcher, "search", lambda *a, **k: pytest.fail("uncached"))
+    assert index.search(f" {name} ") == first
+    assert first and index.reloads == 1
+
+
+def test_config_does_not_open_index(tmp_path, monkeypatch):
+    """Test the app starts without opening the index."""
+    monkeypatch.setenv("WHOOSH_INDEX_DIR", str(tmp_path / "missing"))
+    application = app.create_app()
+    assert application.config["SEARCH_INDEX"].release is None
+    with pytest.raises(FileNotFoundError):
+        application.config["SEARCH_INDEX"].warm()
+
+
+def test_update_in_place(recs_db, tmp_path):
+    """Test an index and store updated in place are reloaded, dropping the cache."""
+    index_path = build(recs_db, tmp_path / "index")
+    index = SearchIndex(index_path, check_interval=0)
+    assert not index.search("Zanzibar")
+    store = index.store
+
+    rename_group(recs_db, 1, "Zanzibar")
+    with contextlib.closing(sqlite3.connect(recs_db)) as conn:
+        make_search_index.update_index(open_dir(index_path), conn)
+    assert index.search("Zanzibar") == (1,)
+
+    make_rec_store.make_store(recs_db, index_path / search.STORE_FILENAME)
+    assert index.store is not store
+    assert index.store.group(1)["name"] == "Zanzibar"
+
+
+def test_symlink_swap(recs_db, tmp_path):
+    """Test a build swapped in behind a symlink is served without a restart."""
+    old = build(recs_db, tmp_path / "old")
+    rename_group(recs_db, 1, "Zanzibar")
+    new = build(recs_db, tmp_path / "new")
+
+    link = tmp_path / "whoosh_index"
+    link.symlink_to(old)
+    index = SearchIndex(link, check_interval=0)
+    assert not index.search("Zanzibar")
+    release = index.release
+
+    os.symlink(new, tmp_path / "tmp")
+    os.replace(tmp_path / "tmp", link)
+    assert index.search("Zanzibar") == (1,)
+    assert index.store.group(1)["name"] == "Zanzibar"
+    assert index.suggest.suggest("zanz")[0]["group_id"] == 1
+
+    # requests holding the old build can finish with it
+    assert release.searcher.document(group_id=1)["name"] != "Zanzibar"
+
+
+def test_versioned_directory(recs_db, tmp_path):
+    """Test the latest build in a versioned directory is served."""
+    versions = tmp_path / "whoosh_index"
+    versions.mkdir()
+    build(recs_db, versions / "0001")
+    index = SearchIndex(versions, check_interval=0)
+    assert not index.search("Zanzibar")
+
+    rename_group(recs_db, 1, "Zanzibar")
+    os.replace(build(recs_db, tmp_path / "staging"), versions / "0002")
+    assert index.search("Zanzibar") == (1,)
+    assert index.release.path.name == "0002"
+
+
+def test_full_index_without_store(recs_db, tmp_path):
+    """Test groups without recommendations are not found, when there is no store."""
+    make_search_index.make_index(recs_db, tmp_path / "index")
+    index = SearchIndex(tmp_path / "index")
+    # the query matches a group without recommendations, and one with them
+    ((group_id, name, other),) = dump_table(
+        recs_db,
+        """
+        select group_id, name, (
+            select name from groups
+            where group_id in (select group_id from recommendations)
+            limit 1
+        )
+        from groups
+        where group_id not in (select group_id from recommendations)
+        limit 1
+        """,
+    )
+    name = f"{name} {other}"
+
+    application = app.create_app(config_file=None)
+    application.config["SEARCH_INDEX"] = index
+    with application.test_client() as client:
+        rv = client.get("/", query_string=dict(q=name))
+
+    assert rv.status_code == 200
+    assert index.search(name)
+    assert group_id not in index.search(name)
+    assert all(index.document(i).get("recommendations_str") for i in index.search(name))
+
+
+def test_swap_keeps_live_searcher(recs_db, tmp_path):
+    """Test a store only swap, then an index swap, keeps the live searcher open."""
+    index_path = build(recs_db, tmp_path / "index")
+    index = SearchIndex(index_path, check_interval=0)
+    index.search("Album")
+
+    make_rec_store.make_store(recs_db, index_path / search.STORE_FILENAME)
+    index.current()
+    rename_group(recs_db, 1, "Zanzibar")
+    with contextlib.closing(sqlite3.connect(recs_db)) as conn:
+        make_search_index.update_index(open_dir(index_path), conn)
+    release = index.release
+    index.current()
+
+    assert index.release is not release
+    assert release.searcher.document(group_id=1)["name"] != "Zanzibar"
+    assert index.search("Zanzibar") == (1,)
+
+
+def test_request_keeps_its_release(recs_db, tmp_path):
+    """Test a swap midway through a request leaves it on the release it started on."""
+    index_path = build(recs_db, tmp_path / "index")
+    index = SearchIndex(index_path, check_interval=0)
+    application = app.create_app(config_file=None)
+    application.config["SEARCH_INDEX"] = index
+
+    with application.test_request_context():
+        store = routes.rec_store()
+        group_id = next(g for g in store.group_ids.tolist() if store.recommendations(g))
+        rename_group(recs_db, group_id, "Zanzibar")
+        with contextlib.closing(sqlite3.connect(recs_db)) as conn:
+            make_search_index.update_index(open_dir(index_path), conn)
+        make_rec_store.make_store(recs_db, index_path / search.STORE_FILENAME)
+        index.current()
+
+        assert routes.rec_store() is store
+        assert routes.release() is not index.release
+        assert not routes.search("Zanzibar")
+        assert routes.enrich_groups(group_id)["name"] != "Zanzibar"
+
+    with application.test_request_context():
+        assert routes.rec_store() is not store
+        assert routes.search("Zanzibar") == [group_id]
+        assert routes.enrich_groups(group_id)["name"] == "Zanzibar"
+
+
+def test_close(recs_db, tmp_path):
+    """Test closing the index closes its searcher."""
+    index = SearchIndex(build(recs_db, tmp_path / "index"))
+    index.warm()
+    searcher = index.release.searcher
+    index.close()
+
+    assert index.release is None
+    assert searcher.reader().is_closed
@@ -0,0 +1,152 @@
+"""Test the recommendation store against the database it was exported from."""
+
+import json
+
+import numpy as np
+import pytest
+
+import app
+from app.store import RecommendationStore, read_arrays, write_arrays
+from build import make_rec_store
+
+from .conftest import dump_table
+
+
+@pytest.fixture
+def store_path(recs_db, tmp_path):
+    """A store built from the synthetic database."""
+    path = tmp_path / "recommendations.bin"
+    make_rec_store.make_store(recs_db, path)
+    return path
+
+
+def test_arrays_roundtrip(tmp_path):
+    """Test arrays come back as written, including empty ones."""
+    arrays = dict(
+        a=np.arange(10, dtype=np.int32),
+        b=np.array([], dtype=np.int64),
+        c=np.linspace(0, 1, 7).reshape(7, 1),
+        d=np.frombuffer("héllo".encode(), dtype=np.uint8),
+    )
+    write_arrays(tmp_path / "x.bin", arrays)
+    result = read_arrays(tmp_path / "x.bin")
+
+    assert list(result) == list(arrays)
+    for name, arr in arrays.items():
+        assert result[name].dtype == arr.dtype
+        np.testing.assert_array_equal(result[name], arr)
+        assert not result[name].flags.writeable
+
+
+def test_store_matches_db(snatch_db, store_path):
+    """Test every group and its recommendations are in the store."""
+    store = RecommendationStore.open(store_path)
+    groups = dump_table(
+        snatch_db,
+        """
+        select group_id, groups.name, artists.name
+        from groups inner join artists using (artist_id)
+        """,
+    )
+    recs = dump_table(
+        snatch_db,
+        """
+        select group_id, recommendation_group_id, recommendation_number, lift
+        from recommendations
+        order by group_id, recommendation_number
+        """,
+    )
+
+    assert len(store) == len(groups)
+    for group_id, name, artist_name in groups:
+        expected = [r for g, r, n, _ in recs if g == group_id and n <= 10]
+        assert store.recommendations(group_id) == expected
+        assert store.group(group_id) == dict(
+            group_id=group_id,
+            name=name,
+            artist_name=artist_name,
+            recommendations=expected,
+        )
+
+    assert any(store.recommendations(g) for g, _, _ in groups)
+    for missing in (-1, 0, 10**9):
+        assert store.group(missing) is None
+        assert store.recommendations(missing) == []
+
+
+def test_app_uses_store(store_path):
+    """Test the API is answered from the store without a search index."""
+    application = app.create_app(config_file=None)
+    application.config["REC_STORE"] = store = RecommendationStore.open(store_path)
+    group_id = next(g for g in store.group_ids.tolist() if store.recommendations(g))
+
+    with application.test_client() as client:
+        rv = client.get("/api/recs", query_string=f"group_id={group_id}")
+    result = json.loads(rv.data.decode())
+
+    assert result["success"]
+    assert result["antecedent"] == store.group(group_id)
+    assert [i["group_id"] for i in result["consequents"]] == store.recommendations(
+        group_id
+    )
+
+
+def naive_basket(snatch_db, group_ids, exclude, k):
+    """Score a basket one seed at a time from the database."""
+    scores = {}
+    for g, r, lift in dump_table(
+        snatch_db, "select group_id, recommendation_group_id, lift from recommendations"
+    ):
+        if g in group_ids and r not in group_ids and r not in exclude:
+            scores[r] = scores.get(r, 0.0) + float(np.float32(lift))
+    return sorted(scores.items(), key=lambda i: (-i[1], i[0]))[:k]
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_basket(snatch_db, store_path, seed):
+    """Test basket scores against a seed by seed sum of lifts."""
+    store = RecommendationStore.open(store_path)
+    rng = np.random.default_rng(seed)
+    group_ids = rng.choice(store.group_ids, size=1 + seed * 5).tolist() + [10**9]
+    exclude = rng.choice(store.group_ids, size=seed).tolist()
+
+    result = store.basket(group_ids, exclude=exclude, k=10)
+    expected = naive_basket(snatch_db, group_ids, exclude, 10)
+
+    assert [i for i, _ in result] == [i for i, _ in expected]
+    np.testing.assert_allclose([i for _, i in result], [i for _, i in expected])
+
+
+def test_basket_api(store_path):
+    """Test the basket API with JSON and url params."""
+    application = app.create_app(config_file=None)
+    application.config["REC_STORE"] = store = RecommendationStore.open(store_path)
+    group_ids = store.group_ids[:20].tolist()
+    expected = store.basket(group_ids, exclude=group_ids[-1:], k=5)
+
+    with application.test_client() as client:
+        rv_json = client.post(
+            "/api/recs/basket",
+            json=dict(group_ids=group_ids, exclude=group_ids[-1:], k=5),
+        )
+        rv_url = client.get(
+            "/api/recs/basket",
+            query_string=dict(
+                group_ids=",".join(map(str, group_ids)), exclude=group_ids[-1], k=5
+            ),
+        )
+
+    for rv in (rv_json, rv_url):
+        result = json.loads(rv.data.decode())
+        assert result["success"]
+        assert [(i["group_id"], i["score"]) for i in result["consequents"]] == expected
+        assert result["consequents"][0]["name"] == store.group(expected[0][0])["name"]
+
+
+def test_default_config_loads_store(store_path, monkeypatch):
+    """Test the app starts with its default config file, loading the store."""
+    monkeypatch.setenv("REC_STORE_PATH", str(store_path))
+    application = app.create_app()
+    store = application.config["REC_STORE"]
+    assert isinstance(store, RecommendationStore)
+    assert len(store) == len(RecommendationStore.open(store_path))
@@ -0,0 +1,102 @@
+"""Test the suggest index against a scan of the database."""
+
+import json
+
+import numpy as np
+import pytest
+
+import app
+from app.suggest import SuggestIndex, best_rows, normalize, word_keys
+from build import make_suggest_index
+
+from .conftest import dump_table
+
+
+@pytest.fixture
+def suggest_path(recs_db, tmp_path):
+    """A suggest index built from the synthetic database."""
+    path = tmp_path / "suggest.bin"
+    make_suggest_index.make_suggest_index(recs_db, path)
+    return path
+
+
+def naive_suggest(snatch_db, query, k):
+    """Suggest groups by scanning every group with recommendations."""
+    groups = dump_table(
+        snatch_db,
+        """
+        select group_id, groups.name, artists.name, groups.snatch_count
+        from groups inner join artists using (artist_id)
+        where group_id in (select group_id from recommendations)
+        """,
+    )
+    prefix = normalize(query)
+    if not prefix:
+        return []
+    matches = sorted(
+        (-snatch_count, group_id, name, artist_name)
+        for group_id, name, artist_name, snatch_count in groups
+        if any(
+            key.startswith(prefix)
+            for key in word_keys(normalize(name)) + word_keys(normalize(artist_name))
+        )
+    )
+    return [
+        dict(group_id=group_id, name=name, artist_name=artist_name)
+        for _, group_id, name, artist_name in matches[:k]
+    ]
+
+
+def test_normalize():
+    """Test accents, case and punctuation are normalized away."""
+    assert normalize("  Björk — HOMOGENIC!! ") == "bjork homogenic"
+    assert normalize("AC/DC") == "ac dc"
+    assert normalize("&$!") == ""
+    assert word_keys("the dark side") == ["the dark side", "dark side", "side"]
+
+
+def test_best_rows_many_keys_per_group():
+    """Test the best distinct groups are found when a few groups hog the best keys."""
+    rows = np.array([0, 1, 2] * 20 + [3, 4, 5, 6], dtype=np.int32)
+    scores = np.array([9, 9, 8] * 20 + [5, 7, 5, 1], dtype=np.int64)
+    assert best_rows(rows, scores, 5).tolist() == [0, 1, 2, 4, 3]
+
+
+@pytest.mark.parametrize("k", [1, 3, 10, 15])
+def test_suggest_matches_scan(snatch_db, suggest_path, k):
+    """Test suggestions against a scan, for short and long prefixes."""
+    suggest = SuggestIndex.open(suggest_path)
+    queries = ["q", "Q", "qu", "mo", "z", "Zen", "QUA", "mon ", "ash & bel", '"zen"']
+    queries += ["x", "&", "", "  "]
+    names = [i for (i,) in dump_table(snatch_db, "select name from groups limit 5")]
+    queries += names + [i.split()[-1] for i in names] + [i[:-1] for i in names]
+
+    for query in queries:
+        assert suggest.suggest(query, k) == naive_suggest(snatch_db, query, k), query
+    assert suggest.suggest("qua", k)
+
+
+def test_suggest_api(suggest_path):
+    """Test the suggest API."""
+    application = app.create_app(config_file=None)
+    application.config["SUGGEST_INDEX"] = suggest = SuggestIndex.open(suggest_path)
+
+    with application.test_client() as client:
+        rv = client.get("/api/suggest", query_string=dict(q="qua", k=3))
+        bad = [
+            client.get("/api/suggest", query_string=query)
+            for query in (dict(), dict(q="qua", k=0), dict(q="qua", k="x"))
+        ]
+
+    result = json.loads(rv.data.decode())
+    assert result == dict(success=True, suggestions=suggest.suggest("qua", 3))
+    assert len(result["suggestions"]) == 3
+    assert [i.status_code for i in bad] == [400] * 3
+
+
+def test_suggest_api_unavailable():
+    """Test the suggest API without a suggest index."""
+    application = app.create_app(config_file=None)
+    with application.test_client() as client:
+        rv = client.get("/api/suggest", query_string="q=albu")
+    assert rv.status_code == 503
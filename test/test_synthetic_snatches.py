@@ -0,0 +1,72 @@
+"""Test the synthetic snatch generator."""
+
+import collections
+
+from build import make_sqlite, synthetic_snatches
+
+from .conftest import build_db, dump_table
+
+
+def test_lines_parse():
+    """Test the lines are in the user_snatches format, and are reproducible."""
+    lines = list(
+        synthetic_snatches.generate_lines(
+            n_users=500, n_groups=200, n_artists=40, error_rate=0.1, seed=3
+        )
+    )
+    parsed = [make_sqlite.parse_line(i) for i in lines]
+
+    assert len(lines) == 500
+    assert 0.05 < sum(i is None for i in parsed) / len(parsed) < 0.15
+    assert lines == list(
+        synthetic_snatches.generate_lines(
+            n_users=500, n_groups=200, n_artists=40, error_rate=0.1, seed=3
+        )
+    )
+    assert lines != list(
+        synthetic_snatches.generate_lines(
+            n_users=500, n_groups=200, n_artists=40, error_rate=0.1, seed=4
+        )
+    )
+
+
+def test_skew(tmp_path):
+    """Test popularity is skewed, and more so with a larger exponent."""
+
+    def top_share(skew):
+        lines = synthetic_snatches.generate_lines(
+            n_users=1000, n_groups=500, n_artists=50, skew=skew, seed=0
+        )
+        db_path = build_db(tmp_path / f"{skew}.db", lines)
+        counts = [i for (i,) in dump_table(db_path, "select snatch_count from groups")]
+        counts.sort(reverse=True)
+        return sum(counts[:10]) / sum(counts)
+
+    assert top_share(0.0) < 0.1 < top_share(1.0) < top_share(1.5)
+
+
+def test_write_lines(tmp_path):
+    """Test the file has one payload per user and every group has one artist."""
+    path = tmp_path / "users.json"
+    synthetic_snatches.write_lines(path, n_users=300, n_groups=100, n_artists=20)
+    db_path = build_db(tmp_path / "data.db", path.read_text().splitlines())
+
+    assert len(path.read_text().splitlines()) == 300
+    artists = collections.Counter(
+        i for (i,) in dump_table(db_path, "select artist_id from groups")
+    )
+    assert max(artists.values()) > 1
+    assert len(dump_table(db_path, "select * from groups")) <= 100
+
+
+def test_first_ids():
+    """Test IDs count up from the first ones, for lines of new users and groups."""
+    lines = synthetic_snatches.generate_lines(
+        n_users=50, n_groups=20, n_artists=5, first_user=101, first_group=1001
+    )
+    parsed = [make_sqlite.parse_line(i) for i in lines]
+
+    users = [user_id for i in parsed if i for user_id, _ in [i[1]]]
+    groups = {group_id for i in parsed if i for group_id, _, _ in i[2]}
+    assert set(users) <= set(range(101, 151))
+    assert groups <= set(range(1001, 1021))
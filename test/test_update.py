@@ -0,0 +1,124 @@
+"""Test the incremental update against a full rebuild."""
+
+import html
+import json
+
+import numpy as np
+import pytest
+
+from app.store import read_arrays
+from build import make_rec_store
+from build import make_recommendations as mr
+from build import make_search_index, update
+
+from .conftest import build_db, dump_table, index_docs, synthetic_lines
+
+RECS_SQL = "select * from recommendations order by group_id, recommendation_number"
+
+
+def build_all(tmp_path, lines, name):
+    """Run the full build, returning the paths of the db, index and store."""
+    db_path = build_db(tmp_path / f"{name}.db", lines)
+    mr.run(db_path, engine="sparse", batch=16)
+    make_search_index.make_index(db_path, tmp_path / f"{name}_index")
+    make_rec_store.make_store(db_path, tmp_path / f"{name}.bin")
+    return db_path, tmp_path / f"{name}_index", tmp_path / f"{name}.bin"
+
+
+def snatch_line(user_id, snatched):
+    """A user with the given snatches."""
+    return json.dumps(
+        dict(
+            user_id=user_id,
+            failed=False,
+            data=dict(status="success", response=dict(snatched=snatched)),
+        )
+    )
+
+
+def renamed_artist_line(user_id):
+    """A user whose payload renames artist 1."""
+    snatched = [dict(groupId=1, name="Album 1", artistId=1, artistName="Renamed")]
+    return snatch_line(user_id, snatched)
+
+
+@pytest.mark.parametrize("delta", ["new_groups", "mixed"])
+def test_update_matches_full_rebuild(tmp_path, snatch_lines, monkeypatch, delta):
+    """Test the incremental update gives the same build as starting over."""
+    # a shallow candidate list, so that some groups are only rescored
+    monkeypatch.setattr(mr, "N_CANDIDATES", 4)
+
+    if delta == "new_groups":
+        new_lines = synthetic_lines(
+            n_users=60,
+            n_groups=16,
+            n_artists=4,
+            seed=1,
+            first_user=1001,
+            first_group=101,
+            first_artist=51,
+        )
+    else:
+        # the next users of the same scrape, some users again, and a renamed artist
+        new_lines = synthetic_lines(n_users=len(snatch_lines) + 30)[len(snatch_lines) :]
+        new_lines += snatch_lines[5:8] + [renamed_artist_line(3001)]
+
+    expected_db, expected_index, expected_store = build_all(
+        tmp_path, snatch_lines + new_lines, "full"
+    )
+    db_path, index_path, store_path = build_all(tmp_path, snatch_lines, "inc")
+
+    json_path = tmp_path / "new.json"
+    json_path.write_text("\n".join(new_lines) + "\n")
+    dirty = update.update(json_path, db_path, index_path, store_path=store_path)
+
+    eligible = dump_table(
+        db_path, "select group_id from groups where snatch_count >= 15"
+    )
+    if delta == "new_groups":
+        assert 0 < len(dirty) < len(eligible)
+    assert dump_table(db_path, RECS_SQL) == dump_table(expected_db, RECS_SQL)
+    assert index_docs(index_path) == index_docs(expected_index)
+
+    result, expected = read_arrays(store_path), read_arrays(expected_store)
+    assert list(result) == list(expected)
+    for name in expected:
+        np.testing.assert_array_equal(result[name], expected[name])
+
+
+def test_update_skewed_delta(tmp_path, snatch_lines, monkeypatch):
+    """Test a few users of popular groups only recompute the lists they change."""
+    monkeypatch.setattr(mr, "N_CANDIDATES", 4)
+    db_path, index_path, _ = build_all(tmp_path, snatch_lines, "inc")
+
+    # the most popular groups share a user with nearly every other group
+    sql = """
+    select group_id, groups.name, artist_id, artists.name
+    from groups
+    inner join artists using (artist_id)
+    order by snatch_count desc
+    limit 2
+    """
+    snatched = [
+        dict(
+            groupId=group_id,
+            name=html.escape(name),
+            artistId=artist_id,
+            artistName=html.escape(artist_name),
+        )
+        for group_id, name, artist_id, artist_name in dump_table(db_path, sql)
+    ]
+    new_lines = [snatch_line(5001, snatched)]
+    expected_db, expected_index, _ = build_all(
+        tmp_path, snatch_lines + new_lines, "full"
+    )
+
+    json_path = tmp_path / "new.json"
+    json_path.write_text("\n".join(new_lines) + "\n")
+    dirty = update.update(json_path, db_path, index_path)
+    eligible = dump_table(
+        db_path, "select group_id from groups where snatch_count >= 15"
+    )
+    assert len(dirty) < len(eligible) / 4
+    assert dump_table(db_path, RECS_SQL) == dump_table(expected_db, RECS_SQL)
+    assert index_docs(index_path) == index_docs(expected_index)
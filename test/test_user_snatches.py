@@ -0,0 +1,124 @@
+"""Test the async scraper against a local stub of the API."""
+
+import asyncio
+import json
+import time
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from build import user_snatches
+
+
+def make_stub_api(hits):
+    """Make a stub API which is slow, flaky, and has missing users.
+
+    Users divisible by 5 do not exist, users divisible by 3 fail with a 503 on their
+    first request, user 11 gets a truncated body on its first request, and user 7
+    always fails.
+    """
+
+    async def handler(request):
+        assert request.headers["Authorization"] == "secret"
+        assert request.query["action"] == "user_torrents"
+        user_id = int(request.query["id"])
+        hits.append(user_id)
+        await asyncio.sleep(0.01)
+
+        if user_id % 5 == 0:
+            body = dict(status="failure", error="no such user")
+            return web.json_response(body, status=400)
+        if user_id == 7 or (user_id % 3 == 0 and hits.count(user_id) == 1):
+            return web.Response(status=503, text="try again")
+        if user_id == 11 and hits.count(user_id) == 1:
+            return web.Response(text='{"status": "succ')
+
+        snatched = [dict(groupId=user_id, name="x", artistId=1, artistName="y")]
+        return web.json_response(
+            dict(status="success", response=dict(snatched=snatched))
+        )
+
+    app = web.Application()
+    app.router.add_get("/ajax.php", handler)
+    return app
+
+
+def run_scrape(filepath, user_ids, hits, **kwargs):
+    """Scrape the users from a stub API."""
+
+    async def go():
+        async with TestServer(make_stub_api(hits)) as server:
+            await user_snatches.scrape(
+                user_ids,
+                filepath,
+                api_url=str(server.make_url("/ajax.php")),
+                api_key="secret",
+                **kwargs,
+            )
+
+    asyncio.run(go())
+
+
+def test_scrape(tmp_path):
+    """Test each user is written once, with retries and missing users handled."""
+    filepath = tmp_path / "users.json"
+    hits = []
+    run_scrape(
+        filepath,
+        range(1, 21),
+        hits,
+        rate=1000,
+        burst=10,
+        concurrency=5,
+        attempts=3,
+        backoff=0.01,
+    )
+
+    result = {}
+    for line in filepath.read_text().splitlines():
+        data = json.loads(line)
+        assert data["user_id"] not in result
+        result[data["user_id"]] = data
+
+    assert sorted(result) == list(range(1, 21))
+    assert result[7] == dict(user_id=7, failed=True, data=dict())
+    assert hits.count(7) == 3
+    assert hits.count(9) == 2
+    assert hits.count(11) == 2
+    assert not result[11]["failed"]
+    assert result[10]["data"]["error"] == "no such user"
+    assert not result[9]["failed"]
+    assert result[9]["data"]["response"]["snatched"][0]["groupId"] == 9
+
+
+def test_scrape_resume(tmp_path):
+    """Test resuming skips scraped users, and cuts off a partial last line."""
+    filepath = tmp_path / "users.json"
+    lines = [
+        json.dumps(dict(user_id=1, failed=False, data=dict())),
+        json.dumps(dict(user_id=2, failed=True, data=dict())),
+        '{"user_id": 3, "fai',
+    ]
+    filepath.write_text("\n".join(lines))
+
+    done = user_snatches.scraped_user_ids(filepath)
+    assert done == {1}
+    assert filepath.read_text() == "\n".join(lines[:2]) + "\n"
+
+    hits = []
+    todo = [i for i in range(1, 5) if i not in done]
+    run_scrape(filepath, todo, hits, rate=1000, concurrency=2, backoff=0.01)
+    assert sorted(hits) == [2, 3, 3, 4]
+    assert user_snatches.scraped_user_ids(filepath) == {1, 2, 3, 4}
+
+
+def test_token_bucket():
+    """Test the limiter spaces out requests after the burst."""
+
+    async def go():
+        limiter = user_snatches.TokenBucket(rate=50, capacity=5)
+        start = time.monotonic()
+        await asyncio.gather(*(limiter.acquire() for _ in range(15)))
+        return time.monotonic() - start
+
+    assert 0.18 <= asyncio.run(go()) < 1